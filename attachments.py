@@ -0,0 +1,114 @@
+import contextlib
+import logging
+import mimetypes
+import os
+
+import atlassian
+
+import image_optimizer
+
+# Limits of a single upload request. Confluence rejects requests that are too large,
+# and a failed request has to be sent again in full.
+MAX_BATCH_SIZE = 20 * 1024 * 1024  # In bytes
+MAX_BATCH_FILES = 20
+
+
+def upload_attachments(
+    wiki_client: atlassian.Confluence,
+    page_id: str,
+    attachment_paths: list[str],
+    attachment_names: dict[str, str] | None = None,
+) -> list[str]:
+    """Attaches files to a page, sending several files per request
+
+    Attachments are named after their file, unless attachment_names has another name
+    for them, by path. Attachments that already exist are updated.
+
+    Returns the paths of the files that could not be attached."""
+    failed_paths = []
+    upload_paths = {
+        attachment_path: image_optimizer.file_to_upload(attachment_path)
+        for attachment_path in attachment_paths
+    }
+    names = {
+        attachment_path: (attachment_names or {}).get(attachment_path)
+        or os.path.basename(attachment_path)
+        for attachment_path in attachment_paths
+    }
+
+    for batch in _split_in_batches(upload_paths, names):
+        logging.info('Attaching files %s to page %s', batch, page_id)
+        try:
+            if len(batch) == 1 and not attachment_names:
+                wiki_client.attach_file(
+                    filename=upload_paths[batch[0]], page_id=page_id
+                )
+            else:
+                _upload_batch(
+                    wiki_client,
+                    page_id,
+                    {names[path]: upload_paths[path] for path in batch},
+                )
+        except Exception:
+            logging.exception('Error attaching %s to page %s:', batch, page_id)
+            failed_paths.extend(batch)
+
+    return failed_paths
+
+
+def _split_in_batches(
+    upload_paths: dict[str, str], names: dict[str, str]
+) -> list[list[str]]:
+    """Groups attachments into batches that can be uploaded in a single request"""
+    batches: list[list[str]] = []
+    batch_names: set[str] = set()
+    batch_size = 0
+
+    for attachment_path, upload_path in upload_paths.items():
+        attachment_name = names[attachment_path]
+        file_size = os.path.getsize(upload_path)
+
+        if (
+            not batches
+            or len(batches[-1]) >= MAX_BATCH_FILES
+            or batch_size + file_size > MAX_BATCH_SIZE
+            # Attachments are identified by name, a request can't have the same twice
+            or attachment_name in batch_names
+        ):
+            batches.append([])
+            batch_names = set()
+            batch_size = 0
+
+        batches[-1].append(attachment_path)
+        batch_names.add(attachment_name)
+        batch_size += file_size
+
+    return batches
+
+
+def _upload_batch(
+    wiki_client: atlassian.Confluence, page_id: str, upload_paths: dict[str, str]
+) -> None:
+    """Uploads files in a single request. upload_paths are by attachment name"""
+    with contextlib.ExitStack() as open_files:
+        files = []
+        for attachment_name, upload_path in upload_paths.items():
+            content_type, _ = mimetypes.guess_type(upload_path)
+            files.append(
+                (
+                    'file',
+                    (
+                        attachment_name,
+                        open_files.enter_context(open(upload_path, mode='rb')),
+                        content_type or 'application/octet-stream',
+                    ),
+                )
+            )
+
+        # Unlike POST, PUT updates the attachments that already exist
+        wiki_client.put(
+            f'rest/api/content/{page_id}/child/attachment',
+            data={'minorEdit': 'true'},
+            headers={'X-Atlassian-Token': 'no-check', 'Accept': 'application/json'},
+            files=files,
+        )
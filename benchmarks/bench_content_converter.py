@@ -0,0 +1,289 @@
+"""Benchmarks the steps of content_converter on synthetic doc files
+
+Generates a corpus of Markdown or RST files with relative links and images, then times
+each step of the conversion separately, against a stub wiki client that doesn't make
+any request:
+
+- convert_to_jira: the conversion by Pandoc, or in-process for simple Markdown
+- extract: finding the relative links in the JIRA markdown
+- fix_links: the whole link rewriting, including the page lookups against the stub
+  client and the attachment checks
+- replace: replacing the relative links, once they are extracted and resolved
+
+Time and peak memory are reported per MB of input. Peak memory is measured with
+tracemalloc, so it doesn't include the Pandoc process.
+
+Run it from the base folder, e.g.:
+
+    python -m benchmarks.bench_content_converter --files 50 --size-kb 20
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+import zlib
+from collections.abc import Callable
+
+import constants
+import content_converter
+
+GH_ROOT = 'https://github.com/owner/repo/blob/main/'
+REPO_NAME = 'repo'
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod'.split()
+
+
+class StubWikiClient:
+    """Answers the requests of ContentConverter without any network access
+
+    Every other doc file has an existing wiki page, and images are already attached."""
+
+    def get_page_by_title(self, space: str, title: str) -> dict | None:
+        if zlib.crc32(title.encode()) % 2:
+            return None
+        return {
+            '_links': {
+                'webui': f'/spaces/{space}/pages/{self.get_page_id(space, title)}'
+            }
+        }
+
+    def get_page_id(self, space: str, title: str) -> str:
+        return str(zlib.crc32(title.encode()))
+
+    def get_attachments_from_content(self, page_id: str, filename: str) -> dict:
+        return {'results': [{'title': filename}]}
+
+    def attach_file(self, filename: str, page_id: str) -> None:
+        pass
+
+
+def generate_corpus(
+    folder: str,
+    file_count: int,
+    size_kb: int,
+    link_density: float,
+    image_count: int,
+    nesting: int,
+    file_format: str,
+    seed: int,
+) -> list[str]:
+    """Writes synthetic doc files under folder. Returns their paths, relative to it
+
+    param link_density: Number of relative links per KB of text
+    param nesting: Depth of the folder tree the files are spread over"""
+    rng = random.Random(seed)
+    file_ext = '.md' if file_format == 'markdown' else '.rst'
+
+    doc_paths = []
+    for file_index in range(file_count):
+        depth = file_index % (nesting + 1)
+        subfolders = [f'level{level}' for level in range(depth)]
+        doc_paths.append(os.path.join(*subfolders, f'doc{file_index}{file_ext}'))
+
+    image_paths = [os.path.join('images', f'image{i}.png') for i in range(image_count)]
+    for path in image_paths:
+        _write_file(folder, path, 'Not actually an image')
+
+    for doc_path in doc_paths:
+        doc_dir = os.path.dirname(doc_path)
+        lines = []
+        size = 0
+        while size < size_kb * 1024:
+            line = _paragraph(rng, doc_dir, doc_paths, link_density, file_format)
+            if len(lines) % 20 == 0:
+                line = _heading(rng, len(lines), file_format) + '\n\n' + line
+            lines.append(line)
+            size += len(line)
+
+        for path in image_paths:
+            relative_path = os.path.relpath(path, doc_dir)
+            if file_format == 'markdown':
+                lines.append(f'![An image]({relative_path})')
+            else:
+                lines.append(f'.. image:: {relative_path}')
+
+        _write_file(folder, doc_path, '\n\n'.join(lines) + '\n')
+
+    return doc_paths
+
+
+def _paragraph(
+    rng: random.Random,
+    doc_dir: str,
+    doc_paths: list[str],
+    link_density: float,
+    file_format: str,
+) -> str:
+    words = [rng.choice(WORDS) for _ in range(80)]
+    # About 500 characters per paragraph
+    for _ in range(_poisson(rng, link_density / 2)):
+        target = os.path.relpath(rng.choice(doc_paths), doc_dir)
+        if file_format == 'markdown':
+            link = f'[{rng.choice(WORDS)}]({target})'
+        else:
+            link = f'`{rng.choice(WORDS)} <{target}>`_'
+        words.insert(rng.randrange(len(words)), link)
+    return ' '.join(words)
+
+
+def _heading(rng: random.Random, index: int, file_format: str) -> str:
+    title = f'{rng.choice(WORDS).title()} {index}'
+    if file_format == 'markdown':
+        return f'## {title}'
+    return f'{title}\n{"-" * len(title)}'
+
+
+def _poisson(rng: random.Random, mean: float) -> int:
+    # Good enough for small means
+    count = 0
+    remaining = rng.expovariate(1) if mean else 0
+    while remaining < mean:
+        count += 1
+        remaining += rng.expovariate(1)
+    return count
+
+
+def _write_file(folder: str, path: str, contents: str) -> None:
+    full_path = os.path.join(folder, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, mode='w', encoding='utf-8') as output_file:
+        output_file.write(contents)
+
+
+def measure(step: Callable[[], object], repeat: int) -> tuple[float, int]:
+    """Returns the median duration of step in seconds, and its peak memory in bytes"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    step()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(durations), peak_memory
+
+
+def run_benchmark(doc_paths: list[str], repeat: int) -> dict[str, dict[str, float]]:
+    """Times each step over the whole corpus. Must run from the corpus folder"""
+    # Used to build the links to existing pages
+    os.environ.setdefault('INPUT_WIKI-BASE-URL', 'https://example.atlassian.net')
+    converter = content_converter.ContentConverter(
+        StubWikiClient(), GH_ROOT, REPO_NAME, 'SPACE'
+    )
+    input_mb = sum(os.path.getsize(path) for path in doc_paths) / 1024 / 1024
+    jira_contents = {
+        path: content_converter.convert_to_jira(path) for path in doc_paths
+    }
+
+    def convert():
+        for path in doc_paths:
+            content_converter.convert_to_jira(path)
+
+    def extract():
+        for path, contents in jira_contents.items():
+            for pattern in (
+                content_converter.JIRA_LINK_PATTERN,
+                content_converter.JIRA_UNNAMED_LINK_PATTERN,
+                content_converter.JIRA_SIMPLE_IMG_PATTERN,
+                content_converter.JIRA_IMG_PATTERN_WITH_PARAMS,
+            ):
+                converter._extract_relative_links(path, contents, pattern)
+
+    def fix_links():
+        for path, contents in jira_contents.items():
+            converter.fix_relative_links(path, contents)
+
+    # Extract and resolve the links once, so replace() only times their replacement
+    resolved_links = {}
+    for path, contents in jira_contents.items():
+        converter.fix_relative_links(path, contents)
+        resolved_links[path] = converter.links_of_last_page
+
+    def replace():
+        for path, contents in jira_contents.items():
+            for link in resolved_links[path]:
+                contents = converter._replace_relative_link(contents, link)
+
+    results = {}
+    for name, step in (
+        ('convert_to_jira', convert),
+        ('extract', extract),
+        ('fix_links', fix_links),
+        ('replace', replace),
+    ):
+        duration, peak_memory = measure(step, repeat)
+        results[name] = {
+            'seconds': duration,
+            'seconds_per_mb': duration / input_mb,
+            'peak_mb_per_mb': peak_memory / 1024 / 1024 / input_mb,
+        }
+    results['input'] = {'files': len(doc_paths), 'mb': input_mb}
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20, help='Number of doc files')
+    parser.add_argument(
+        '--size-kb', type=int, default=10, help='Approximate size of each file'
+    )
+    parser.add_argument(
+        '--link-density', type=float, default=2, help='Relative links per KB'
+    )
+    parser.add_argument('--images', type=int, default=3, help='Images per file')
+    parser.add_argument('--nesting', type=int, default=3, help='Folder tree depth')
+    parser.add_argument('--format', choices=['markdown', 'rst'], default='markdown')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    initial_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as corpus_folder:
+        doc_paths = generate_corpus(
+            corpus_folder,
+            args.files,
+            args.size_kb,
+            args.link_density,
+            args.images,
+            args.nesting,
+            args.format,
+            args.seed,
+        )
+        # Relative links are resolved from the current folder, like in a real sync.
+        # The Pandoc filters need to be found from there as well.
+        constants.PANDOC_FILTERS_FOLDER = os.path.abspath(
+            constants.PANDOC_FILTERS_FOLDER
+        )
+        os.chdir(corpus_folder)
+        try:
+            results = run_benchmark(doc_paths, args.repeat)
+        finally:
+            os.chdir(initial_dir)
+
+    print(
+        f'{results["input"]["files"]} files, {results["input"]["mb"]:.2f} MB of input'
+    )
+    print(f'{"step":<16} {"seconds":>10} {"s/MB":>10} {"peak MB/MB":>12}')
+    for name in ('convert_to_jira', 'extract', 'fix_links', 'replace'):
+        result = results[name]
+        print(
+            f'{name:<16} {result["seconds"]:>10.4f} {result["seconds_per_mb"]:>10.4f}'
+            f' {result["peak_mb_per_mb"]:>12.3f}'
+        )
+
+    if json_path:
+        with open(json_path, mode='w', encoding='utf-8') as json_file:
+            json.dump(results, json_file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,18 @@ import enum
 import logging
 import os
 import re
+import subprocess
 
 import atlassian
 import pypandoc
 
+import attachments
 import constants
+import manifest
+import markdown_renderer
+import page_index
+import profiling
+import shared_assets
 
 # GENERAL NOTE about the regex patterns: we want them to be non-greedy
 # https://docs.python.org/3/howto/regex.html#greedy-versus-non-greedy
@@ -40,6 +47,95 @@ class RelativeLink:
     wiki_link: str  # Link to be used in the final wiki page
 
 
+class ConversionLimitExceeded(Exception):
+    """The conversion of a file would take too long, or the file is too large"""
+
+
+def convert_to_jira(
+    file_path: str,
+    timeout: float | None = None,
+    max_file_size: int | None = None,
+    fast_markdown: bool = True,
+) -> str:
+    """Converts a doc file to JIRA markdown, leaving relative links as they are
+
+    This is the expensive part of the conversion. It doesn't depend on where the page
+    is uploaded, so its output can be shared between wiki spaces.
+
+    param timeout: Maximum duration of the conversion, in seconds
+    param max_file_size: Maximum size of the file, in bytes
+    param fast_markdown: Convert simple Markdown files without Pandoc
+    raises ConversionLimitExceeded: If the file is too large, or the conversion takes
+        too long"""
+    if max_file_size and os.path.getsize(file_path) > max_file_size:
+        raise ConversionLimitExceeded(
+            f'{file_path} is larger than {max_file_size} bytes'
+        )
+
+    _, file_ext = os.path.splitext(file_path)
+
+    if file_ext == '.md' and fast_markdown:
+        try:
+            return markdown_renderer.render_file(file_path)
+        except (markdown_renderer.UnsupportedMarkdown, UnicodeDecodeError) as e:
+            logging.debug('Converting %s with Pandoc: %s', file_path, e)
+
+    filters = []
+    if file_ext == '.rst':
+        filters = [f'{constants.PANDOC_FILTERS_FOLDER}/rst_note_warning.lua']
+
+    if not timeout:
+        return pypandoc.convert_file(file_path, 'jira', filters=filters)
+
+    # pypandoc can't stop Pandoc, but subprocess kills it when the timeout expires
+    try:
+        result = subprocess.run(
+            [pypandoc.get_pandoc_path(), '--to=jira', file_path]
+            + [f'--lua-filter={lua_filter}' for lua_filter in filters],
+            capture_output=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        raise ConversionLimitExceeded(
+            f'Conversion of {file_path} took more than {timeout}s'
+        ) from None
+
+    if result.returncode != 0:
+        raise RuntimeError(
+            f'Pandoc failed with exit code {result.returncode}:'
+            f' {result.stderr.decode("utf-8", errors="replace")}'
+        )
+    return result.stdout.decode('utf-8', errors='replace')
+
+
+def render_source(
+    file_path: str,
+    source_url: str,
+    reason: str = 'could not be converted',
+    max_size: int | None = None,
+) -> str:
+    """Cheap JIRA markdown for a file that can't be converted: its source, as is
+
+    param max_size: Maximum size of the source to include, in bytes. The rest is only
+        linked to."""
+    with open(file_path, mode='rb') as source_file:
+        source_bytes = source_file.read(max_size + 1 if max_size else -1)
+    truncated = bool(max_size) and len(source_bytes) > max_size
+    source = source_bytes[: max_size or None].decode('utf-8', errors='replace')
+
+    # Nothing is formatted until the next {noformat}, so the source can't contain one.
+    # A zero-width space keeps it from being parsed.
+    source = source.replace('{noformat}', '{\u200bnoformat}')
+
+    contents = (
+        f'This file {reason}, see [the original|{source_url}].\n'
+        f'{{noformat}}\n{source.rstrip()}\n{{noformat}}\n'
+    )
+    if truncated:
+        contents += f'The file is truncated, [view the full file|{source_url}].\n'
+    return contents
+
+
 class ContentConverter:
     """A wrapper around Pandoc, with Confluence-specific improvements
 
@@ -51,30 +147,44 @@ class ContentConverter:
         wiki_client: atlassian.Confluence,
         gh_root: str,
         repo_name: str,
+        space_name: str | None = None,
     ) -> str:
         self.wiki_client = wiki_client
         self.gh_root = gh_root
         self.repo_name = repo_name
+        self.space_name = space_name or os.environ['INPUT_SPACE-NAME']
 
         self.files_to_attach_to_last_page: list[str] = []
+        # Relative links found in the last converted file, with their wiki links
+        self.links_of_last_page: list[RelativeLink] = []
+
+        # Pages known to exist, by title. They don't need to be looked up.
+        self.known_pages: dict[str, page_index.IndexedPage] = {}
+        # Whether known_pages lists all the pages, so the others don't exist
+        self.pages_listed = False
+        # Hash of the attachments of the page being converted, by attachment name.
+        # When set, attachments are only uploaded if their content changed.
+        self.attachment_hashes: dict[str, str] | None = None
+        # When set, images are attached to this page instead of the pages using them
+        self.shared_assets: shared_assets.SharedAssetsPage | None = None
 
     def convert_file_contents(self, file_path: str) -> str:
-        self.files_to_attach_to_last_page = []
-
-        _, file_ext = os.path.splitext(file_path)
-
-        filters = []
-        if file_ext == '.rst':
-            filters = [f'{constants.PANDOC_FILTERS_FOLDER}/rst_note_warning.lua']
+        return self.fix_relative_links(file_path, convert_to_jira(file_path))
 
-        formated_file_contents = pypandoc.convert_file(
-            file_path, 'jira', filters=filters
-        )
+    def fix_relative_links(self, file_path: str, jira_contents: str) -> str:
+        """Updates the relative links of JIRA markdown converted from file_path"""
+        self.files_to_attach_to_last_page = []
+        self.links_of_last_page = []
 
-        return self._replace_relative_links(file_path, formated_file_contents)
+        return self._replace_relative_links(file_path, jira_contents)
 
     def _replace_relative_links(self, file_path: str, contents: str) -> str:
         links: list[RelativeLink] = []
+        # Images to attach to the page of the file, if it already exists
+        attachment_paths: list[str] = []
+        # Images to attach to the shared assets page
+        shared_asset_paths: list[str] = []
+        page_id = None
 
         for pattern in (
             JIRA_LINK_PATTERN,
@@ -93,33 +203,50 @@ class ContentConverter:
             # First we decide what the wiki link will be
             if link.link_type == RelativeLinkType.GENERIC:
                 wiki_page_name = f'{self.repo_name}/{link.target_path}'
-                wiki_page_info = self.wiki_client.get_page_by_title(
-                    os.environ['INPUT_SPACE-NAME'], wiki_page_name
-                )
-                if wiki_page_info:
+                if wiki_page_name in self.known_pages:
+                    target_page_webui = self.known_pages[wiki_page_name].webui
+                elif self.pages_listed:
+                    target_page_webui = None
+                else:
+                    with profiling.stage('upload'):
+                        wiki_page_info = self.wiki_client.get_page_by_title(
+                            self.space_name, wiki_page_name
+                        )
+                    target_page_webui = (
+                        wiki_page_info['_links']['webui'] if wiki_page_info else None
+                    )
+
+                if target_page_webui:
                     # The link is to a file that has a Confluence page
                     # Let's link to the page directly
                     target_page_url = (
-                        os.environ['INPUT_WIKI-BASE-URL']
-                        + '/wiki'
-                        + wiki_page_info['_links']['webui']
+                        os.environ['INPUT_WIKI-BASE-URL'] + '/wiki' + target_page_webui
                     )
                     link.wiki_link = target_page_url
                 else:
                     # No existing Confluence page - link to GitHub
                     link.wiki_link = self.gh_root + link.target_path
 
+            elif link.link_type == RelativeLinkType.IMAGE and self.shared_assets:
+                link.wiki_link = self.shared_assets.reference(link.target_path)
+                shared_asset_paths.append(link.target_path)
+
             elif link.link_type == RelativeLinkType.IMAGE:
                 _, attachment_name = os.path.split(link.target_path)
                 link.wiki_link = attachment_name
 
                 wiki_page_name = f'{self.repo_name}/{file_path}'
-                page_id = self.wiki_client.get_page_id(
-                    os.environ['INPUT_SPACE-NAME'], wiki_page_name
-                )
+                if not page_id and wiki_page_name in self.known_pages:
+                    page_id = self.known_pages[wiki_page_name].page_id
+                elif not page_id and not self.pages_listed:
+                    # Not already looked up for a previous image
+                    with profiling.stage('upload'):
+                        page_id = self.wiki_client.get_page_id(
+                            self.space_name, wiki_page_name
+                        )
 
                 if page_id:
-                    self._attach_to_page(page_id, link.target_path)
+                    attachment_paths.append(link.target_path)
                 else:  # Page doesn't exist yet (is being created)
                     logging.debug(
                         "%s needs to be attached to page %s, which hasn't"
@@ -135,6 +262,14 @@ class ContentConverter:
             # Then we replace the relative links
             contents = self._replace_relative_link(contents, link)
 
+        # The requests to Confluence aren't part of the link rewriting itself
+        with profiling.stage('upload'):
+            if attachment_paths:
+                self._attach_to_page(page_id, attachment_paths)
+            if shared_asset_paths:
+                self.shared_assets.upload(shared_asset_paths)
+
+        self.links_of_last_page = links
         return contents
 
     def _extract_relative_links(
@@ -207,21 +342,42 @@ class ContentConverter:
             )
             return text
 
-    def _attach_to_page(self, page_id: str, attachment_path: str) -> None:
+    def _attach_to_page(self, page_id: str, attachment_paths: list[str]) -> None:
+        paths_to_upload = []
+        for attachment_path in dict.fromkeys(attachment_paths):
+            if self._needs_upload(page_id, attachment_path):
+                paths_to_upload.append(attachment_path)
+
+        failed_paths = attachments.upload_attachments(
+            self.wiki_client, page_id, paths_to_upload
+        )
+        if failed_paths:
+            raise Exception(f'Could not attach {failed_paths} to page {page_id}')
+
+    def _needs_upload(self, page_id: str, attachment_path: str) -> bool:
         _, attachment_name = os.path.split(attachment_path)
 
+        if self.attachment_hashes is not None:
+            # We know what was uploaded: no need to look at the existing attachments
+            attachment_hash = manifest.file_hash(attachment_path)
+            if self.attachment_hashes.get(attachment_name) == attachment_hash:
+                logging.debug('Attachment %s is up to date', attachment_name)
+                return False
+            # Also updates the attachment if it already exists
+            return True
+
         # TODO This doesn't handle the case of a doc file including two different
         # images with the same file name (#23)
         logging.debug('Looking for an attachment named %s', attachment_name)
-        attachments = self.wiki_client.get_attachments_from_content(
+        existing_attachments = self.wiki_client.get_attachments_from_content(
             page_id, filename=attachment_name
         )['results']
 
-        if attachments:
-            logging.debug('%s attachment(s) found', len(attachments))
+        if existing_attachments:
+            logging.debug('%s attachment(s) found', len(existing_attachments))
             # TODO Figure out whether we want to update the image (#24)
             # The API doesn't tell us when the file was last updated, so we can't
             # compare that to the last commit on that file
-        else:
-            logging.info('Attaching file %s to page %s', attachment_path, page_id)
-            self.wiki_client.attach_file(filename=attachment_path, page_id=page_id)
+            return False
+
+        return True
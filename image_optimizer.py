@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+import PIL.Image
+import PIL.ImageOps
+
+# Raster formats that can be downsized and recompressed without changing their type
+OPTIMIZABLE_EXTENSIONS = {'.jpeg', '.jpg', '.png', '.webp'}
+JPEG_QUALITY = 85
+
+DEFAULT_CACHE_FOLDER = '.wiki-sync/images'
+
+
+def file_to_upload(image_path: str) -> str:
+    """Returns the path of the file to upload for an image
+
+    If image optimization is enabled (image-max-dimension or image-max-file-size), large
+    images are downsized and recompressed first. Otherwise, or if the image can't be
+    improved, this is the original image."""
+    max_dimension = int(os.environ.get('INPUT_IMAGE-MAX-DIMENSION') or 0)
+    max_file_size = int(os.environ.get('INPUT_IMAGE-MAX-FILE-SIZE') or 0) * 1024
+    if not max_dimension and not max_file_size:
+        return image_path
+
+    cache_folder = os.environ.get('INPUT_IMAGE-CACHE-FOLDER') or DEFAULT_CACHE_FOLDER
+    try:
+        return optimize_image(image_path, max_dimension, max_file_size, cache_folder)
+    except Exception:
+        logging.warning(
+            'Could not optimize image %s, uploading it as is', image_path, exc_info=True
+        )
+        return image_path
+
+
+def optimize_image(
+    image_path: str, max_dimension: int, max_file_size: int, cache_folder: str
+) -> str:
+    """Downsizes and recompresses an image if it's too large
+
+    param max_dimension: Maximum width and height in pixels, 0 for no limit
+    param max_file_size: Size in bytes above which the image is recompressed, 0 for no
+        limit
+    returns: Path of the optimized image, with the same file name as the original
+
+    Optimized images are cached by content hash, so the same image is only optimized
+    once, even across runs if the cache folder is persisted."""
+    _, file_ext = os.path.splitext(image_path)
+    if file_ext.lower() not in OPTIMIZABLE_EXTENSIONS:
+        return image_path
+
+    with open(image_path, mode='rb') as image_file:
+        image_hash = hashlib.sha256(image_file.read())
+    # The result also depends on the settings
+    image_hash.update(f'{max_dimension}:{max_file_size}:{JPEG_QUALITY}'.encode())
+
+    # Keep the original file name, since it's also the name of the attachment
+    cached_path = os.path.join(
+        cache_folder, image_hash.hexdigest(), os.path.basename(image_path)
+    )
+    if os.path.exists(cached_path):
+        logging.debug('Using cached optimized image %s', cached_path)
+        return cached_path
+
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    # Several targets may optimize the same image at the same time: only make the
+    # cached image visible once it's complete
+    temp_path = f'{cached_path}.{uuid.uuid4().hex}.tmp'
+    with PIL.Image.open(image_path) as original_image:
+        if getattr(original_image, 'is_animated', False):
+            # Saving it would only keep the first frame
+            logging.debug('Not optimizing animated image %s', image_path)
+            return image_path
+
+        image_format = original_image.format
+        too_large = max_dimension and max(original_image.size) > max_dimension
+        too_heavy = max_file_size and os.path.getsize(image_path) > max_file_size
+        if too_large or too_heavy:
+            # The EXIF orientation isn't saved, so rotate the pixels instead
+            image = PIL.ImageOps.exif_transpose(original_image)
+            if too_large:
+                # Keeps the aspect ratio
+                image.thumbnail((max_dimension, max_dimension))
+
+            save_options = {'optimize': True}
+            if file_ext.lower() in {'.jpeg', '.jpg', '.webp'}:
+                save_options['quality'] = JPEG_QUALITY
+            image.save(temp_path, format=image_format, **save_options)
+
+    if not os.path.exists(temp_path):
+        # Nothing to do, but remember it
+        shutil.copyfile(image_path, temp_path)
+    elif os.path.getsize(temp_path) >= os.path.getsize(image_path):
+        # Recompressing didn't help, keep the original
+        shutil.copyfile(image_path, temp_path)
+    else:
+        logging.info(
+            'Optimized image %s from %s to %s bytes',
+            image_path,
+            os.path.getsize(image_path),
+            os.path.getsize(temp_path),
+        )
+
+    os.replace(temp_path, cached_path)
+    return cached_path
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import threading
+
+# Steps of the sync of a file, in order. A file is converted once, then its page is
+# written and its attachments uploaded for each space.
+CONVERTED = 'converted'
+PAGE_WRITTEN = 'page-written'
+ATTACHMENTS_UPLOADED = 'attachments-uploaded'
+
+
+class SyncJournal:
+    """Append-only record of the completed steps of a sync, for a given commit
+
+    If a sync is interrupted, running it again for the same commit can skip the steps
+    that were already completed. Each step is written to the journal file as soon as
+    it's completed, one JSON object per line, so nothing is lost if the job is killed.
+
+    A journal for a different commit is discarded."""
+
+    def __init__(self, journal_path: str, commit_sha: str) -> None:
+        self.journal_path = journal_path
+        self.commit_sha = commit_sha
+        # (step, file path, space name) -> details of the step
+        self.steps: dict[tuple[str, str, str], dict] = {}
+        # Spaces are synced concurrently
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The job was probably killed while writing this line
+                    logging.warning('Ignoring invalid journal line %r', line)
+                    continue
+
+                if entry['commit'] != self.commit_sha:
+                    logging.info(
+                        'Discarding journal %s of commit %s',
+                        self.journal_path,
+                        entry['commit'],
+                    )
+                    self.steps = {}
+                    os.remove(self.journal_path)
+                    return
+
+                key = (entry['step'], entry['file'], entry['space'])
+                self.steps[key] = entry['details']
+
+        logging.info(
+            'Resuming sync of commit %s, %s steps already done',
+            self.commit_sha,
+            len(self.steps),
+        )
+
+    def is_done(self, step: str, file_path: str, space_name: str = '') -> bool:
+        return (step, file_path, space_name) in self.steps
+
+    def get(self, step: str, file_path: str, space_name: str = '') -> dict | None:
+        """Returns the details of a completed step, or None if it wasn't completed"""
+        return self.steps.get((step, file_path, space_name))
+
+    def record(
+        self, step: str, file_path: str, space_name: str = '', **details
+    ) -> None:
+        if not self.journal_path:
+            return
+
+        entry = {
+            'commit': self.commit_sha,
+            'step': step,
+            'file': file_path,
+            'space': space_name,
+            'details': details,
+        }
+        with self._lock:
+            self.steps[(step, file_path, space_name)] = details
+
+            journal_dir = os.path.dirname(self.journal_path)
+            if journal_dir:
+                os.makedirs(journal_dir, exist_ok=True)
+            with open(self.journal_path, mode='a', encoding='utf-8') as journal_file:
+                print(json.dumps(entry), file=journal_file, flush=True)
@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+
+
+class LinkGraph:
+    """Records the relative links of each synced file
+
+    For every source file, the graph keeps the files it links to, and whether each
+    link pointed to a Confluence page (resolved) or to GitHub (unresolved) when the
+    page was last rendered. When a file gets its page, the files with an unresolved
+    link to it can be re-rendered.
+
+    The graph is stored as a JSON file, so it can be persisted between runs."""
+
+    def __init__(self, graph_path: str) -> None:
+        self.graph_path = graph_path
+        # Source file path -> {target file path -> whether the link was resolved}
+        self.links: dict[str, dict[str, bool]] = {}
+
+    def load(self) -> None:
+        if not self.graph_path or not os.path.exists(self.graph_path):
+            logging.debug('No existing link graph at %s', self.graph_path)
+            return
+
+        try:
+            with open(self.graph_path, encoding='utf-8') as graph_file:
+                self.links = json.load(graph_file)
+        except (OSError, ValueError):
+            logging.warning(
+                'Could not read link graph %s, starting from scratch',
+                self.graph_path,
+                exc_info=True,
+            )
+            self.links = {}
+
+    def save(self) -> None:
+        if not self.graph_path:
+            return
+
+        graph_dir = os.path.dirname(self.graph_path)
+        if graph_dir:
+            os.makedirs(graph_dir, exist_ok=True)
+
+        with open(self.graph_path, mode='w', encoding='utf-8') as graph_file:
+            json.dump(self.links, graph_file, indent=1, sort_keys=True)
+
+    def record(self, source_path: str, targets: dict[str, bool]) -> None:
+        """Replaces the outgoing links of source_path"""
+        self.links[source_path] = targets
+
+    def sources_with_unresolved_links_to(self, target_paths: set[str]) -> list[str]:
+        """Returns the files that link to any of target_paths through GitHub"""
+        return sorted(
+            source_path
+            for source_path, targets in self.links.items()
+            if any(
+                not resolved and target_path in target_paths
+                for target_path, resolved in targets.items()
+            )
+        )
@@ -0,0 +1,115 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+
+import page_index
+
+
+@dataclasses.dataclass
+class ManifestEntry:
+    """What we know about the page of a synced file after the last sync"""
+
+    page_id: str
+    version: int
+    body_hash: str  # Hash of the page contents we uploaded
+    # Hash of each attachment we uploaded, by attachment name
+    attachments: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+class SyncManifest:
+    """Maps the synced files to their pages, in each space
+
+    With the manifest, a sync doesn't need to look pages up: it knows their ID and
+    version, and whether their contents and attachments changed since the last sync.
+    It is stored as a JSON file, so it can be persisted between runs.
+
+    The manifest can be out of date, e.g. if someone edited or deleted a page. It
+    needs to be validated against the pages that actually exist before being used."""
+
+    def __init__(self, manifest_path: str) -> None:
+        self.manifest_path = manifest_path
+        # Space name -> file path -> entry
+        self.entries: dict[str, dict[str, ManifestEntry]] = {}
+
+    def load(self) -> None:
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            logging.debug('No existing manifest at %s', self.manifest_path)
+            return
+
+        try:
+            with open(self.manifest_path, encoding='utf-8') as manifest_file:
+                self.entries = {
+                    space_name: {
+                        file_path: ManifestEntry(**entry)
+                        for file_path, entry in space_entries.items()
+                    }
+                    for space_name, space_entries in json.load(manifest_file).items()
+                }
+        except (OSError, TypeError, ValueError):
+            logging.warning(
+                'Could not read manifest %s, starting from scratch',
+                self.manifest_path,
+                exc_info=True,
+            )
+            self.entries = {}
+
+    def save(self) -> None:
+        if not self.manifest_path:
+            return
+
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+
+        with open(self.manifest_path, mode='w', encoding='utf-8') as manifest_file:
+            json.dump(
+                {
+                    space_name: {
+                        file_path: dataclasses.asdict(entry)
+                        for file_path, entry in space_entries.items()
+                    }
+                    for space_name, space_entries in self.entries.items()
+                },
+                manifest_file,
+                indent=1,
+                sort_keys=True,
+            )
+
+    def get(self, space_name: str, file_path: str) -> ManifestEntry | None:
+        return self.entries.get(space_name, {}).get(file_path)
+
+    def set(self, space_name: str, file_path: str, entry: ManifestEntry) -> None:
+        self.entries.setdefault(space_name, {})[file_path] = entry
+
+    def forget(self, space_name: str) -> None:
+        """Drops all the entries of a space, e.g. when its pages can't be listed"""
+        self.entries.pop(space_name, None)
+
+    def validate(
+        self, space_name: str, pages: dict[str, page_index.IndexedPage]
+    ) -> None:
+        """Drops what's out of date, given the pages that exist, by file path
+
+        If a page was deleted or recreated, its entry is removed. If it was edited, we
+        keep its new version, but its contents need to be uploaded again."""
+        space_entries = self.entries.get(space_name, {})
+        for file_path, entry in list(space_entries.items()):
+            page = pages.get(file_path)
+            if not page or page.page_id != entry.page_id:
+                logging.debug('Page of %s no longer exists', file_path)
+                del space_entries[file_path]
+            elif page.version != entry.version:
+                logging.info('Page of %s was edited since the last sync', file_path)
+                entry.version = page.version
+                entry.body_hash = ''
+
+
+def file_hash(file_path: str) -> str:
+    with open(file_path, mode='rb') as hashed_file:
+        return hashlib.sha256(hashed_file.read()).hexdigest()
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
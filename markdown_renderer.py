@@ -0,0 +1,440 @@
+"""
+Converts simple Markdown files to JIRA markdown without Pandoc
+
+Only a subset of Markdown is supported: ATX headings, paragraphs, bullet and ordered
+lists, fenced code blocks, emphasis, inline code, links and images. The output is
+the same as Pandoc's. Anything else, or anything Pandoc might read differently,
+like smart punctuation, raises UnsupportedMarkdown so the file can be converted by
+Pandoc instead.
+"""
+
+import re
+
+# Characters that JIRA markdown may need escaped
+SPECIAL_CHARS = frozenset('_+-*^~|[]{}(!?&:;\\')
+SPECIAL_CHAR_PATTERN = re.compile(f'([ {re.escape("".join(sorted(SPECIAL_CHARS)))}])')
+# A run of text without inline markup
+PLAIN_TEXT_PATTERN = re.compile(r'!?[^`*_!\[\]]*')
+EMPHASIS_DELIMITER_PATTERN = re.compile(r'\*+|_+')
+
+HEADING_PATTERN = re.compile(r'(#{1,6}) +(.+?) *')
+FENCE_PATTERN = re.compile(r'(`{3,}|~{3,}) *([A-Za-z0-9+-]*) *')
+LIST_ITEM_PATTERN = re.compile(r'( *)([*+-]|\d{1,9}[.)]) (\S.*)')
+# Lines that Pandoc could read as something other than a paragraph line: block
+# quotes, tables, HTML, horizontal rules, setext headings, fancy lists...
+BLOCK_START_PATTERN = re.compile(
+    r' {4}|[>|<:%]|\(?(?:[A-Za-z]|[ivxlcdmIVXLCDM]+|\d+|#|@\w*)[.)](?: |$)|#|```|~~~'
+    r'|[-+*] |[-=_*+: ]+$'
+)
+# Inline constructs that aren't supported, anywhere in a block. Pandoc's smart
+# extension turns quotes, dashes and ellipses into typographic characters, and
+# abbreviations get a non-breaking space.
+UNSUPPORTED_INLINE_PATTERN = re.compile(
+    r'[<>\\~^"|\t\u00a0]|--|\.\.\.|\?\?|&#?\w+;|(?:^|\s)@|\]\[|[`)\]*_]\{'
+    r'|(?<![^\W\d_])\'|\'(?![^\W\d_])|  $'
+    r'|(?:^|\s)(?:Mr|Mrs|Ms|Capt|Dr|Prof|Gen|Gov|e\.g|i\.e|Sgt|St|vol|vs|Sen|Rep'
+    r'|Pres|Hon|Rev|Ph\.D|M\.D|M\.A|p|pp|ch|sec|cf|cp|No|Nos|Fig|Figs|etc)\.(?!\S)',
+    re.MULTILINE | re.IGNORECASE,
+)
+ICON_PATTERN = re.compile(r'(?:\w{1,8}|/)\)')
+URL_PATTERN = re.compile(r'[A-Za-z0-9._~:/?#@$&+,;=%-]+')
+IMAGE_ALT_PATTERN = re.compile(r'(?:[A-Za-z0-9_.-]+(?: [A-Za-z0-9_.-]+)*)?')
+
+PARAGRAPH = 'paragraph'
+LIST = 'list'
+HEADING = 'heading'
+CODE = 'code'
+
+
+class UnsupportedMarkdown(Exception):
+    """The Markdown uses something that only Pandoc can convert"""
+
+
+def render_file(file_path: str) -> str:
+    with open(file_path, encoding='utf-8') as markdown_file:
+        return render(markdown_file.read())
+
+
+def render(text: str) -> str:
+    """Converts Markdown to JIRA markdown, as Pandoc would
+
+    raises UnsupportedMarkdown: If the text isn't in the supported subset"""
+    text = text.replace('\r\n', '\n')
+    if '\r' in text or text.startswith('\ufeff'):
+        raise UnsupportedMarkdown('Unusual line endings or byte order mark')
+    lines = text.split('\n')
+
+    blocks: list[tuple[str, str]] = []
+    used_identifiers: set[str] = set()
+    line_index = 0
+    while line_index < len(lines):
+        line = lines[line_index].rstrip(' ')
+        if not line:
+            line_index += 1
+        elif heading_match := HEADING_PATTERN.fullmatch(line):
+            heading = _render_heading(
+                len(heading_match[1]), heading_match[2], used_identifiers
+            )
+            blocks.append((HEADING, heading))
+            line_index += 1
+        elif fence_match := FENCE_PATTERN.fullmatch(line):
+            code_block, line_index = _render_code_block(
+                lines, line_index, fence_match[1], fence_match[2]
+            )
+            blocks.append((CODE, code_block))
+        elif LIST_ITEM_PATTERN.fullmatch(line):
+            list_block, line_index = _render_list(lines, line_index)
+            blocks.append((LIST, list_block))
+        else:
+            paragraph, line_index = _render_paragraph(lines, line_index)
+            blocks.append((PARAGRAPH, paragraph))
+
+    jira_text = ''
+    previous_block_type = None
+    for block_type, block in blocks:
+        if previous_block_type:
+            jira_text += '\n\n' if previous_block_type in (PARAGRAPH, LIST) else '\n'
+        jira_text += block
+        previous_block_type = block_type
+    return jira_text + '\n'
+
+
+def _render_heading(level: int, text: str, used_identifiers: set[str]) -> str:
+    if text.endswith('#') or text.endswith('}') or not text.isascii():
+        raise UnsupportedMarkdown(f'Unsupported heading: {text}')
+    inlines = _parse_text(text)
+    if any(node[0] not in ('str', 'special', 'space') for node in inlines):
+        raise UnsupportedMarkdown(f'Unsupported heading: {text}')
+
+    # Pandoc's auto_identifiers extension
+    identifier = '-'.join(
+        ''.join(
+            char for char in text.lower() if char.isalnum() or char in '_-. '
+        ).split()
+    )
+    identifier = identifier.lstrip('0123456789_-.') or 'section'
+    unique_identifier = identifier
+    suffix = 1
+    while unique_identifier in used_identifiers:
+        unique_identifier = f'{identifier}-{suffix}'
+        suffix += 1
+    used_identifiers.add(unique_identifier)
+
+    return f'h{level}. {{anchor:{unique_identifier}}}{_render_inlines(inlines)}'
+
+
+def _render_code_block(
+    lines: list[str], line_index: int, fence: str, language: str
+) -> tuple[str, int]:
+    for end_index in range(line_index + 1, len(lines)):
+        end_line = lines[end_index].rstrip(' ')
+        if end_line.startswith(fence) and not end_line.strip(fence[0]):
+            break
+    else:
+        raise UnsupportedMarkdown('Unclosed code block')
+
+    code = '\n'.join(lines[line_index + 1 : end_index])
+    if '{code' in code or '{noformat' in code or '\t' in code:
+        raise UnsupportedMarkdown('Code block that JIRA markdown cannot hold')
+
+    if language:
+        # Pandoc renames some languages, like objective-c
+        language = language.lower()
+        if not language.isalnum():
+            raise UnsupportedMarkdown(f'Unsupported code block language: {language}')
+        return f'{{code:{language}}}\n{code}\n{{code}}', end_index + 1
+    return f'{{noformat}}\n{code}{{noformat}}', end_index + 1
+
+
+def _render_list(lines: list[str], line_index: int) -> tuple[str, int]:
+    # Lists being rendered, as (indentation, content column, marker, JIRA marker)
+    levels: list[tuple[int, int, str, str]] = []
+    items: list[tuple[str, str]] = []
+
+    while line_index < len(lines) and lines[line_index].strip():
+        if lines[line_index].endswith('  '):
+            raise UnsupportedMarkdown('Line break in a list')
+        line = lines[line_index].rstrip(' ')
+        item_match = LIST_ITEM_PATTERN.fullmatch(line)
+        if not item_match:
+            # The continuation of the text of the last item
+            if not line.startswith(' ' * levels[-1][1]) or BLOCK_START_PATTERN.match(
+                line.strip()
+            ):
+                raise UnsupportedMarkdown(f'Unsupported list item: {line}')
+            prefix, item_text = items[-1]
+            items[-1] = (prefix, f'{item_text} {line.strip()}')
+            line_index += 1
+            continue
+
+        indentation, marker, item_text = item_match.groups()
+        if BLOCK_START_PATTERN.match(item_text):
+            raise UnsupportedMarkdown(f'Unsupported list item: {line}')
+        indentation_size = len(indentation)
+        marker_type = marker if marker in '*+-' else marker[-1]
+        while levels and indentation_size < levels[-1][0]:
+            levels.pop()
+        if not levels:
+            if indentation_size > 3:
+                raise UnsupportedMarkdown(f'Unsupported list item: {line}')
+        elif indentation_size == levels[-1][0]:
+            if marker_type != levels[-1][2]:
+                raise UnsupportedMarkdown(f'Mixed list markers: {line}')
+            levels.pop()
+        elif not levels[-1][1] <= indentation_size <= levels[-1][1] + 3:
+            raise UnsupportedMarkdown(f'Unsupported list item: {line}')
+
+        levels.append(
+            (
+                indentation_size,
+                indentation_size + len(marker) + 1,
+                marker_type,
+                '*' if marker in '*+-' else '#',
+            )
+        )
+        items.append((''.join(level[3] for level in levels), item_text))
+        line_index += 1
+
+    # Loose lists, or list items with several paragraphs
+    next_index = line_index
+    while next_index < len(lines) and not lines[next_index].strip():
+        next_index += 1
+    if next_index < len(lines) and (
+        lines[next_index].startswith(' ')
+        or LIST_ITEM_PATTERN.fullmatch(lines[next_index].rstrip(' '))
+    ):
+        raise UnsupportedMarkdown('Loose list')
+
+    return '\n'.join(
+        f'{prefix} {_render_text(item_text)}' for prefix, item_text in items
+    ), line_index
+
+
+def _render_paragraph(lines: list[str], line_index: int) -> tuple[str, int]:
+    first_line = lines[line_index]
+    if BLOCK_START_PATTERN.match(first_line) or BLOCK_START_PATTERN.match(
+        first_line.lstrip()
+    ):
+        raise UnsupportedMarkdown(f'Unsupported block: {first_line}')
+
+    paragraph_lines = [first_line]
+    line_index += 1
+    while line_index < len(lines) and lines[line_index].strip():
+        line = lines[line_index]
+        if FENCE_PATTERN.fullmatch(line.rstrip(' ')):
+            break
+        if BLOCK_START_PATTERN.match(line.strip()):
+            raise UnsupportedMarkdown(f'Unsupported paragraph line: {line}')
+        paragraph_lines.append(line)
+        line_index += 1
+
+    return _render_text('\n'.join(paragraph_lines)), line_index
+
+
+def _render_text(text: str) -> str:
+    return _render_inlines(_parse_text(text))
+
+
+def _parse_text(text: str) -> list[tuple]:
+    if UNSUPPORTED_INLINE_PATTERN.search(text.rstrip(' ')):
+        raise UnsupportedMarkdown(f'Unsupported inline markup in: {text}')
+    if text.count('$') > 1:
+        raise UnsupportedMarkdown(f'Possible math in: {text}')
+    return _parse_inlines(' '.join(text.split()))
+
+
+def _parse_inlines(text: str) -> list[tuple]:
+    """Parses text with single spaces into a list of nodes:
+
+    ('str', text), ('special', char), ('space',), ('styled', delimiter, nodes),
+    ('link', nodes, url) and ('image', url, alt)"""
+    nodes: list[tuple] = []
+    word = ''
+
+    def flush_word() -> None:
+        nonlocal word
+        # Pandoc's smart extension curls apostrophes
+        nodes.extend(_split_text(word.replace("'", '\u2019')))
+        word = ''
+
+    index = 0
+    while index < len(text):
+        char = text[index]
+        previous_char = text[index - 1] if index else ' '
+        if char == '`':
+            flush_word()
+            end_index = text.find('`', index + 1)
+            code = text[index + 1 : end_index]
+            if (
+                end_index == -1
+                or previous_char != ' '
+                or not code.strip()
+                or code != code.strip()
+                or text[end_index + 1 : end_index + 2] == '`'
+            ):
+                raise UnsupportedMarkdown(f'Unsupported inline code: {text}')
+            nodes.append(('styled', ('{{', '}}'), _parse_code(code)))
+            index = end_index + 1
+        elif char in '*_':
+            delimiter = EMPHASIS_DELIMITER_PATTERN.match(text, index)[0]
+            next_char = text[index + len(delimiter) : index + len(delimiter) + 1]
+            if previous_char == ' ' and next_char in ('', ' '):
+                # A lone star or underscore between spaces, unless it could still
+                # open or close emphasis
+                if len(delimiter) > 1 or char in text[index + 1 :]:
+                    raise UnsupportedMarkdown(f'Unsupported emphasis: {text}')
+                word += delimiter
+                index += len(delimiter)
+                continue
+            if previous_char != ' ' or len(delimiter) > 2:
+                if char == '*' or previous_char == ' ' or len(delimiter) > 1:
+                    raise UnsupportedMarkdown(f'Unsupported emphasis: {text}')
+                if not (previous_char.isalnum() and next_char.isalnum()):
+                    raise UnsupportedMarkdown(f'Unsupported emphasis: {text}')
+                # An underscore within a word
+                word += char
+                index += 1
+                continue
+
+            flush_word()
+            end_index = text.find(delimiter, index + len(delimiter))
+            content = text[index + len(delimiter) : end_index]
+            after_end = text[
+                end_index + len(delimiter) : end_index + len(delimiter) + 1
+            ]
+            if (
+                end_index == -1
+                or not content
+                or content != content.strip()
+                or char in content
+                or after_end.isalnum()
+                or after_end in ('*', '_')
+            ):
+                raise UnsupportedMarkdown(f'Unsupported emphasis: {text}')
+            jira_delimiter = '_' if len(delimiter) == 1 else '*'
+            nodes.append(
+                ('styled', (jira_delimiter, jira_delimiter), _parse_inlines(content))
+            )
+            index = end_index + len(delimiter)
+        elif char == '!' and text[index + 1 : index + 2] == '[':
+            flush_word()
+            end_index = text.find(']', index)
+            alt = text[index + 2 : end_index]
+            if end_index == -1 or not IMAGE_ALT_PATTERN.fullmatch(alt):
+                raise UnsupportedMarkdown(f'Unsupported image: {text}')
+            url, index = _parse_url(text, end_index + 1)
+            nodes.append(('image', url, alt))
+        elif char == '[':
+            flush_word()
+            end_index = text.find(']', index)
+            link_text = text[index + 1 : end_index]
+            if end_index == -1 or not link_text.strip() or '[' in link_text:
+                raise UnsupportedMarkdown(f'Unsupported link: {text}')
+            url, index = _parse_url(text, end_index + 1)
+            nodes.append(('link', _parse_inlines(link_text), url))
+        elif char == ']':
+            raise UnsupportedMarkdown(f'Unsupported link: {text}')
+        else:
+            plain_text = PLAIN_TEXT_PATTERN.match(text, index)[0]
+            word += plain_text
+            index += len(plain_text)
+
+    flush_word()
+    return nodes
+
+
+def _parse_code(code: str) -> list[tuple]:
+    if '  ' in code:
+        raise UnsupportedMarkdown(f'Unsupported inline code: {code}')
+    return _split_text(code)
+
+
+def _split_text(text: str) -> list[tuple]:
+    """Splits text without markup into words, spaces and special characters"""
+    nodes: list[tuple] = []
+    for piece in SPECIAL_CHAR_PATTERN.split(text):
+        if piece == ' ':
+            nodes.append(('space',))
+        elif piece in SPECIAL_CHARS:
+            nodes.append(('special', piece))
+        elif piece:
+            nodes.append(('str', piece))
+    return nodes
+
+
+def _parse_url(text: str, index: int) -> tuple[str, int]:
+    """Parses the (url) after a link text, returns the URL and where it ends"""
+    if text[index : index + 1] != '(':
+        raise UnsupportedMarkdown(f'Unsupported link: {text}')
+    end_index = text.find(')', index)
+    url = text[index + 1 : end_index]
+    if end_index == -1 or not URL_PATTERN.fullmatch(url):
+        raise UnsupportedMarkdown(f'Unsupported link URL: {text}')
+    return url, end_index + 1
+
+
+def _render_inlines(nodes: list[tuple]) -> str:
+    """Renders the nodes as Pandoc's JIRA writer does, escaping the special
+    characters that JIRA could read as markup"""
+    jira_text = ''
+    for node_index, node in enumerate(nodes):
+        previous_type = nodes[node_index - 1][0] if node_index else None
+        next_node = nodes[node_index + 1] if node_index + 1 < len(nodes) else None
+        next_type = next_node[0] if next_node else None
+
+        if node[0] == 'str':
+            jira_text += node[1]
+        elif node[0] == 'space':
+            jira_text += ' '
+        elif node[0] == 'special':
+            char = node[1]
+            if char in '{}':
+                jira_text += '\\' + char
+            elif (previous_type, next_type) == ('str', 'str'):
+                if char == '(' and ICON_PATTERN.match(next_node[1]):
+                    # Could be read as a JIRA icon, like (x)
+                    raise UnsupportedMarkdown(f'Possible icon: {next_node[1]}')
+                jira_text += char
+            elif (previous_type, next_type) == ('space', 'space'):
+                jira_text += char
+            elif char in ':;':
+                if next_type not in (None, 'space'):
+                    raise UnsupportedMarkdown(f'Possible smiley: {char}')
+                jira_text += char
+            elif char == '?':
+                jira_text += char
+            else:
+                jira_text += '\\' + char
+        elif node[0] == 'styled':
+            # JIRA needs another syntax for markup within words
+            if previous_type == 'str' or (
+                next_type == 'str' and next_node[1][0].isalnum()
+            ):
+                raise UnsupportedMarkdown('Markup within a word')
+            opening, closing = node[1]
+            jira_text += opening + _render_inlines(node[2]) + closing
+        elif node[0] == 'link':
+            if _to_plain_text(node[1]) == node[2]:
+                jira_text += f'[{node[2]}]'
+            else:
+                jira_text += f'[{_render_inlines(node[1])}|{node[2]}]'
+        elif node[0] == 'image':
+            alt = f'|alt={node[2]}' if node[2] else ''
+            jira_text += f'!{node[1]}{alt}!'
+    return jira_text
+
+
+def _to_plain_text(nodes: list[tuple]) -> str:
+    plain_text = ''
+    for node in nodes:
+        if node[0] in ('str', 'special'):
+            plain_text += node[1]
+        elif node[0] == 'space':
+            plain_text += ' '
+        elif node[0] == 'styled':
+            plain_text += _to_plain_text(node[2])
+        elif node[0] == 'link':
+            plain_text += _to_plain_text(node[1])
+        elif node[0] == 'image':
+            plain_text += node[2]
+    return plain_text
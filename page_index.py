@@ -0,0 +1,54 @@
+import dataclasses
+import logging
+
+import atlassian
+
+# Maximum number of pages returned by a single search request
+SEARCH_PAGE_SIZE = 200
+
+
+@dataclasses.dataclass
+class IndexedPage:
+    """A wiki page, as returned by a search"""
+
+    page_id: str
+    title: str
+    version: int
+    webui: str  # Link to the page, relative to the wiki's base URL
+    body: str | None = None  # Contents in storage format, if they were listed
+
+
+def list_descendant_pages(
+    wiki_client: atlassian.Confluence, root_page_id: int, with_body: bool = False
+) -> dict[str, IndexedPage]:
+    """Lists all the pages under the root page, at any depth, by title
+
+    Uses a CQL search rather than walking the tree, so a whole subtree only costs one
+    request per SEARCH_PAGE_SIZE pages. If with_body, the contents of the pages are
+    listed too."""
+    pages: dict[str, IndexedPage] = {}
+
+    path = 'rest/api/content/search'
+    params = {
+        'cql': f'ancestor = {root_page_id} and type = page',
+        'expand': 'version,body.storage' if with_body else 'version',
+        'limit': SEARCH_PAGE_SIZE,
+    }
+    while path:
+        response = wiki_client.get(path, params=params)
+        for result in response['results']:
+            pages[result['title']] = IndexedPage(
+                page_id=result['id'],
+                title=result['title'],
+                version=result['version']['number'],
+                webui=result['_links']['webui'],
+                body=result['body']['storage']['value'] if with_body else None,
+            )
+
+        # The link to the next results contains all the parameters it needs
+        next_link = response.get('_links', {}).get('next')
+        path = next_link.lstrip('/') if next_link else None
+        params = None
+
+    logging.debug('Found %s pages under page %s', len(pages), root_page_id)
+    return pages
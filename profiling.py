@@ -0,0 +1,120 @@
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+
+# Stage that each thread is currently in, by thread ID
+_thread_stages: dict[int, str] = {}
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Marks the code run in this block as part of a stage of the sync
+
+    The samples of the profiler are grouped by stage. When the profiler isn't running,
+    this doesn't cost anything noticeable."""
+    thread_id = threading.get_ident()
+    previous_stage = _thread_stages.get(thread_id)
+    _thread_stages[thread_id] = name
+    try:
+        yield
+    finally:
+        if previous_stage is None:
+            del _thread_stages[thread_id]
+        else:
+            _thread_stages[thread_id] = previous_stage
+
+
+class Profiler:
+    """Profiles a sync, with two complementary profilers
+
+    - cProfile, which counts every call of the main thread. The result can be opened
+      with the usual tools, e.g. snakeviz.
+    - A sampler, which regularly records the stack of every thread that is in a stage.
+      The samples are saved in the "collapsed stacks" format, one file per stage and
+      one for the whole run, that flamegraph.pl or speedscope.app render as
+      flamegraphs. Unlike cProfile, it sees the worker threads, and the time spent
+      waiting on the network."""
+
+    def __init__(self, sampling_interval: float = 0.005) -> None:
+        self.sampling_interval = sampling_interval
+        # Collapsed stack ("stage;outer frame;...;inner frame") -> number of samples
+        self.samples: collections.Counter[str] = collections.Counter()
+
+        self._profile = cProfile.Profile()
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample_until_stopped, name='profiler', daemon=True
+        )
+
+    def __enter__(self) -> 'Profiler':
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._profile.disable()
+        self._stop_sampling.set()
+        self._sampler.join()
+
+    def save(self, output_folder: str) -> None:
+        os.makedirs(output_folder, exist_ok=True)
+
+        self._profile.dump_stats(os.path.join(output_folder, 'profile.prof'))
+        summary_path = os.path.join(output_folder, 'profile-summary.txt')
+        with open(summary_path, mode='w', encoding='utf-8') as summary_file:
+            stats = pstats.Stats(self._profile, stream=summary_file)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+
+        samples_by_stage: dict[str, dict[str, int]] = {}
+        for stack, count in self.samples.items():
+            stage_name, _, _ = stack.partition(';')
+            samples_by_stage.setdefault(stage_name, {})[stack] = count
+
+        self._write_collapsed_stacks(
+            os.path.join(output_folder, 'profile.collapsed'), self.samples
+        )
+        for stage_name, samples in samples_by_stage.items():
+            file_name = f'profile-{stage_name.replace(" ", "-")}.collapsed'
+            self._write_collapsed_stacks(
+                os.path.join(output_folder, file_name), samples
+            )
+
+        logging.info(
+            'Saved profile to %s. Samples by stage: %s',
+            output_folder,
+            {
+                stage_name: sum(samples.values())
+                for stage_name, samples in samples_by_stage.items()
+            },
+        )
+
+    @staticmethod
+    def _write_collapsed_stacks(file_path: str, samples: dict[str, int]) -> None:
+        with open(file_path, mode='w', encoding='utf-8') as collapsed_file:
+            for stack, count in sorted(samples.items()):
+                print(f'{stack} {count}', file=collapsed_file)
+
+    def _sample_until_stopped(self) -> None:
+        main_thread_id = threading.main_thread().ident
+        while not self._stop_sampling.wait(self.sampling_interval):
+            for thread_id, frame in sys._current_frames().items():
+                stage_name = _thread_stages.get(thread_id)
+                if not stage_name:
+                    if thread_id != main_thread_id:
+                        # e.g. idle worker threads, or the sampler itself
+                        continue
+                    stage_name = 'other'
+
+                frames = []
+                while frame:
+                    code = frame.f_code
+                    file_name = os.path.basename(code.co_filename)
+                    frames.append(f'{code.co_name} ({file_name}:{code.co_firstlineno})')
+                    frame = frame.f_back
+
+                self.samples[';'.join([stage_name] + frames[::-1])] += 1
@@ -0,0 +1,185 @@
+import html
+import logging
+import os
+import re
+
+import atlassian
+import requests
+
+import attachments
+import manifest
+import page_index
+
+# Number of attachments listed per request
+ATTACHMENTS_PAGE_SIZE = 200
+# Attachments are named after the first 16 characters of the hash of their file
+HASHED_NAME_PATTERN = re.compile(r'[0-9a-f]{16}-')
+# How pages refer to attachments, in storage format. The name is XML-escaped.
+ATTACHMENT_REFERENCE_PATTERN = re.compile(r'ri:filename="([^"]*)"')
+
+
+def page_title(repo_name: str) -> str:
+    # Not a valid path in the repository, so it can't clash with the page of a file
+    return f'{repo_name} assets'
+
+
+class SharedAssetsPage:
+    """A page holding the images of all the synced files, each uploaded once
+
+    Attachments are named after a hash of their contents, so an image used by many
+    files is only uploaded once, and an image that changed gets a new attachment."""
+
+    def __init__(
+        self, wiki_client: atlassian.Confluence, page_id: str, title: str
+    ) -> None:
+        self.wiki_client = wiki_client
+        self.page_id = page_id
+        self.title = title
+        # Names of the attachments of the page
+        self.attachment_names: set[str] = set()
+
+    def load_attachment_names(self) -> None:
+        start = 0
+        while True:
+            results = self.wiki_client.get_attachments_from_content(
+                self.page_id, start=start, limit=ATTACHMENTS_PAGE_SIZE
+            )['results']
+            self.attachment_names.update(result['title'] for result in results)
+            if len(results) < ATTACHMENTS_PAGE_SIZE:
+                break
+            start += len(results)
+
+        logging.debug(
+            'Shared assets page %s has %s attachments',
+            self.title,
+            len(self.attachment_names),
+        )
+
+    def attachment_name(self, file_path: str) -> str:
+        return f'{manifest.file_hash(file_path)[:16]}-{os.path.basename(file_path)}'
+
+    def reference(self, file_path: str) -> str:
+        """How pages refer to the attachment of a file, in JIRA markdown images"""
+        return f'{self.title}^{self.attachment_name(file_path)}'
+
+    def upload(self, file_paths: list[str]) -> None:
+        """Attaches the files that aren't attached yet"""
+        names = {file_path: self.attachment_name(file_path) for file_path in file_paths}
+        missing_paths = [
+            file_path
+            for file_path, name in names.items()
+            if name not in self.attachment_names
+        ]
+        if not missing_paths:
+            return
+
+        failed_paths = attachments.upload_attachments(
+            self.wiki_client, self.page_id, missing_paths, names
+        )
+        if failed_paths:
+            raise Exception(f'Could not attach {failed_paths} to page {self.title}')
+        self.attachment_names.update(names[file_path] for file_path in missing_paths)
+
+    def prune(self, page_bodies: list[str], dry_run: bool = False) -> bool:
+        """Removes the attachments that none of the page bodies refer to anymore, e.g.
+        old versions of an image. Returns True if all of them were removed"""
+        referenced_names = {
+            html.unescape(name)
+            for body in page_bodies
+            for name in ATTACHMENT_REFERENCE_PATTERN.findall(body)
+        }
+        unreferenced_names = sorted(
+            name
+            for name in self.attachment_names
+            if HASHED_NAME_PATTERN.match(name) and name not in referenced_names
+        )
+        logging.info(
+            '%s unreferenced attachments on page %s: %s',
+            len(unreferenced_names),
+            self.title,
+            unreferenced_names,
+        )
+        if dry_run:
+            return True
+
+        success = True
+        for name in unreferenced_names:
+            try:
+                self.wiki_client.delete_attachment(self.page_id, name)
+            except Exception:
+                logging.exception('Error removing attachment %s:', name)
+                success = False
+                continue
+            self.attachment_names.discard(name)
+        return success
+
+
+def get_shared_assets_page(
+    wiki_client: atlassian.Confluence,
+    space_name: str,
+    root_page_id: int,
+    repo_name: str,
+    known_pages: dict[str, page_index.IndexedPage] | None = None,
+    pages_listed: bool = False,
+) -> SharedAssetsPage | None:
+    """Finds the shared assets page under the root page, or creates it
+
+    known_pages and pages_listed are the pages under the root page, as in
+    create_folder_pages. Page titles are unique in a space, so if a page with the same
+    title exists outside of the root page, returns None. Other shards of the same sync
+    may create the page at the same time, in which case it is used."""
+    title = page_title(repo_name)
+    if title in (known_pages or {}):
+        page_id = known_pages[title].page_id
+    elif pages_listed:
+        page_id = None
+    else:
+        page_id = wiki_client.get_page_id(space_name, title)
+        if page_id and not _is_under(wiki_client, page_id, root_page_id):
+            logging.error(
+                'Page %s exists outside of the root page, attaching images to each'
+                ' page instead',
+                title,
+            )
+            return None
+
+    if not page_id:
+        logging.info('Creating shared assets page %s', title)
+        try:
+            page_id = wiki_client.create_page(
+                space=space_name,
+                title=title,
+                body='{attachments}',
+                parent_id=root_page_id,
+                representation='wiki',
+            )['id']
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:
+                raise
+
+            # Confluence answers with a 400 when a page with that title already exists
+            page_id = wiki_client.get_page_id(space_name, title)
+            if not page_id:
+                raise
+            if _is_under(wiki_client, page_id, root_page_id):
+                logging.info(
+                    'Page %s was created concurrently with id %s', title, page_id
+                )
+            else:
+                logging.error(
+                    'Page %s exists outside of the root page, attaching images to'
+                    ' each page instead',
+                    title,
+                )
+                return None
+
+    assets_page = SharedAssetsPage(wiki_client, page_id, title)
+    assets_page.load_attachment_names()
+    return assets_page
+
+
+def _is_under(
+    wiki_client: atlassian.Confluence, page_id: str, root_page_id: int
+) -> bool:
+    ancestors = wiki_client.get_page_by_id(page_id, expand='ancestors')['ancestors']
+    return any(str(ancestor['id']) == str(root_page_id) for ancestor in ancestors)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Keeps wiki_sync running in the background of a clone of the repository, and syncs
+the doc files whenever the default branch is pushed to
+
+Unlike a run of the action, the connections to Confluence, the root pages, the
+written pages and the conversions of the files are kept between syncs.
+"""
+
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import wiki_sync
+
+# Pushes made within this many seconds of each other are synced together
+DEFAULT_DEBOUNCE_DELAY = 30
+# A sync doesn't wait longer than this for the pushes to stop
+MAX_DEBOUNCE_DELAY = 300
+# How many converted files are kept in memory
+CONVERSION_CACHE_SIZE = 2000
+# A failed sync is tried again after this many seconds, even without a new push
+DEFAULT_RETRY_DELAY = 300
+
+
+class SyncDaemon:
+    """Syncs the changes of the default branch, whenever it is told it was pushed to
+
+    Pushes are coalesced: the sync waits for them to stop for a while, then syncs all
+    the files changed since the last synced commit at once. If the sync fails, it is
+    tried again after retry_delay."""
+
+    def __init__(
+        self,
+        debounce_delay: float = DEFAULT_DEBOUNCE_DELAY,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+    ) -> None:
+        self.debounce_delay = debounce_delay
+        self.retry_delay = retry_delay
+        self.branch = _default_branch()
+        # The checkout is expected to be synced when the daemon starts
+        self.last_synced_commit = _git('rev-parse', 'HEAD')
+
+        self.target_runs = None
+        self.conversion_cache: dict[str, str] = {}
+        # Pages written by previous syncs, by space name and file path, with their
+        # current version. They are updated without being looked up.
+        self.known_pages: dict[tuple[str, str], wiki_sync.KnownPage] = {}
+        self._pushed = threading.Event()
+
+    def notify_push(self) -> None:
+        self._pushed.set()
+
+    def has_pending_push(self) -> bool:
+        return self._pushed.is_set()
+
+    def run(self) -> None:
+        """Syncs the pushed changes, forever"""
+        while True:
+            self._wait_for_pushes()
+            self.sync_or_retry_later()
+
+    def sync_or_retry_later(self) -> None:
+        """Syncs the pushed changes. If that fails, schedules another attempt"""
+        try:
+            success = self.sync_pushed_changes()
+        except Exception:
+            logging.exception('Error syncing the pushed changes')
+            success = False
+
+        if not success:
+            logging.info('Trying again in %ss', self.retry_delay)
+            retry_timer = threading.Timer(self.retry_delay, self.notify_push)
+            retry_timer.daemon = True
+            retry_timer.start()
+
+    def _wait_for_pushes(self) -> None:
+        self._pushed.wait()
+        first_push_time = time.monotonic()
+        self._pushed.clear()
+
+        while time.monotonic() - first_push_time < MAX_DEBOUNCE_DELAY:
+            if not self._pushed.wait(self.debounce_delay):
+                return  # No other push for a while
+            self._pushed.clear()
+
+    def sync_pushed_changes(self) -> bool:
+        """Pulls the default branch, and syncs the files changed since the last sync
+
+        Returns True if the sync was successful"""
+        _git('fetch', '--quiet', 'origin', self.branch)
+        new_commit = _git('rev-parse', 'FETCH_HEAD')
+        if new_commit == self.last_synced_commit:
+            logging.info('Nothing new on %s', self.branch)
+            return True
+
+        # Compare the trees rather than following the history, so it also works after
+        # a force push. The checkout only follows the remote, so it can be reset.
+        changed_files = _git(
+            'diff', '--name-only', self.last_synced_commit, new_commit
+        ).splitlines()
+        _git('reset', '--quiet', '--hard', new_commit)
+
+        files_to_sync = wiki_sync.get_files_to_sync('|'.join(changed_files))
+        logging.info(
+            'Syncing %s to %s, files: %s',
+            self.last_synced_commit,
+            new_commit,
+            files_to_sync,
+        )
+
+        # The journal is per commit
+        os.environ['GITHUB_SHA'] = new_commit
+        self.target_runs = self.target_runs or wiki_sync.create_target_runs()
+        if not self.target_runs:
+            return False
+        success = wiki_sync.sync_files(
+            files_to_sync,
+            known_pages=self.known_pages,
+            target_runs=self.target_runs,
+            conversion_cache=self.conversion_cache,
+        )
+        self._trim_conversion_cache()
+
+        if success:
+            self.last_synced_commit = new_commit
+        else:
+            # The changes will be synced again by the next attempt
+            logging.error('Sync of %s failed', new_commit)
+        return success
+
+    def _trim_conversion_cache(self) -> None:
+        # The oldest conversions are dropped first
+        for cache_key in list(self.conversion_cache)[:-CONVERSION_CACHE_SIZE]:
+            del self.conversion_cache[cache_key]
+
+
+class PushHandler(http.server.BaseHTTPRequestHandler):
+    """Receives the push webhooks of GitHub
+
+    If the webhook has a secret, it is expected in the webhook-secret input."""
+
+    sync_daemon: SyncDaemon
+
+    def do_GET(self) -> None:
+        self._respond(
+            200,
+            {
+                'last_synced_commit': self.sync_daemon.last_synced_commit,
+                'pending': self.sync_daemon.has_pending_push(),
+            },
+        )
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if not self._has_valid_signature(body):
+            self._respond(401, {'error': 'Invalid signature'})
+            return
+
+        if self.headers.get('X-GitHub-Event', 'push') != 'push':
+            self._respond(200, {'status': 'ignored'})
+            return
+
+        try:
+            ref = json.loads(body).get('ref')
+        except ValueError:
+            self._respond(400, {'error': 'Invalid JSON'})
+            return
+
+        if ref != f'refs/heads/{self.sync_daemon.branch}':
+            self._respond(200, {'status': 'ignored'})
+            return
+
+        self.sync_daemon.notify_push()
+        self._respond(202, {'status': 'queued'})
+
+    def _has_valid_signature(self, body: bytes) -> bool:
+        secret = os.environ.get('INPUT_WEBHOOK-SECRET', '')
+        if not secret:
+            return True
+
+        expected_signature = 'sha256=' + (
+            hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        )
+        return hmac.compare_digest(
+            expected_signature, self.headers.get('X-Hub-Signature-256', '')
+        )
+
+    def _respond(self, status: int, response: dict) -> None:
+        response_body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(format, *args)
+
+
+def poll_remote(sync_daemon: SyncDaemon, poll_interval: float) -> None:
+    """Notifies the daemon when the default branch changes on the remote"""
+    last_seen_commit = sync_daemon.last_synced_commit
+    while True:
+        time.sleep(poll_interval)
+        try:
+            remote_refs = _git(
+                'ls-remote', 'origin', f'refs/heads/{sync_daemon.branch}'
+            )
+        except subprocess.CalledProcessError:
+            logging.exception('Could not poll the remote')
+            continue
+
+        remote_commit, _, _ = remote_refs.partition('\t')
+        if remote_commit and remote_commit != last_seen_commit:
+            logging.info('%s is now at %s', sync_daemon.branch, remote_commit)
+            last_seen_commit = remote_commit
+            sync_daemon.notify_push()
+
+
+def _default_branch() -> str:
+    """Returns INPUT_DEFAULT-GIT-BRANCH, or the default branch of the remote if it is
+    HEAD or empty, since pushes and ls-remote name the actual branch"""
+    branch = os.environ.get('INPUT_DEFAULT-GIT-BRANCH', '')
+    if branch not in ('', 'HEAD'):
+        return branch
+
+    try:
+        remote_head = _git('symbolic-ref', 'refs/remotes/origin/HEAD')
+    except subprocess.CalledProcessError:
+        raise RuntimeError(
+            'Could not find the default branch of the remote, '
+            'set INPUT_DEFAULT-GIT-BRANCH to the name of the branch to sync'
+        ) from None
+    return remote_head.removeprefix('refs/remotes/origin/')
+
+
+def _git(*args: str) -> str:
+    return subprocess.run(
+        ['git', *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('atlassian.confluence').setLevel(logging.INFO)
+    logging.getLogger('atlassian.rest_client').setLevel(logging.INFO)
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.INFO)
+
+    sync_daemon = SyncDaemon(
+        float(os.environ.get('INPUT_DEBOUNCE-DELAY') or DEFAULT_DEBOUNCE_DELAY),
+        float(os.environ.get('INPUT_RETRY-DELAY') or DEFAULT_RETRY_DELAY),
+    )
+
+    poll_interval = float(os.environ.get('INPUT_POLL-INTERVAL') or 0)
+    if poll_interval:
+        threading.Thread(
+            target=poll_remote, args=(sync_daemon, poll_interval), daemon=True
+        ).start()
+
+    webhook_port = int(os.environ.get('INPUT_WEBHOOK-PORT') or 0)
+    if webhook_port:
+        PushHandler.sync_daemon = sync_daemon
+        server = http.server.ThreadingHTTPServer(('', webhook_port), PushHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info('Listening for push webhooks on port %s', webhook_port)
+
+    if not poll_interval and not webhook_port:
+        raise SystemExit('Set the webhook-port input, the poll-interval input or both')
+
+    sync_daemon.run()
@@ -0,0 +1,99 @@
+"""Tests that the attachments of a page are uploaded in as few requests as possible"""
+
+import os
+from unittest import mock
+
+import pytest
+
+import attachments
+
+
+@pytest.fixture(autouse=True)
+def use_temp_dir(tmp_path, monkeypatch):
+    # tmp_path is the path to a pytest-provided temporary folder
+    # Run the test inside it, so the files it creates are cleaned up afterwards
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('INPUT_IMAGE-MAX-DIMENSION', '')
+
+
+def write_file(file_path: str, size: int = 10) -> None:
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, mode='wb') as written_file:
+        written_file.write(b'x' * size)
+
+
+def uploaded_names(put_call) -> list[str]:
+    return [file_info[0] for _, file_info in put_call.kwargs['files']]
+
+
+def test_several_files_in_one_request():
+    for name in ('a.png', 'b.png', 'c.svg'):
+        write_file(name)
+    wiki_mock = mock.MagicMock()
+
+    failed = attachments.upload_attachments(
+        wiki_mock, '123', ['a.png', 'b.png', 'c.svg']
+    )
+
+    assert failed == []
+    wiki_mock.attach_file.assert_not_called()
+    wiki_mock.put.assert_called_once()
+    put_call = wiki_mock.put.call_args
+    assert put_call.args == ('rest/api/content/123/child/attachment',)
+    assert uploaded_names(put_call) == ['a.png', 'b.png', 'c.svg']
+    assert put_call.kwargs['files'][2][1][2] == 'image/svg+xml'
+
+
+def test_single_file():
+    write_file('a.png')
+    wiki_mock = mock.MagicMock()
+
+    assert attachments.upload_attachments(wiki_mock, '123', ['a.png']) == []
+
+    wiki_mock.attach_file.assert_called_once_with(filename='a.png', page_id='123')
+    wiki_mock.put.assert_not_called()
+
+
+def test_batches_are_bounded():
+    paths = [f'image{index}.png' for index in range(5)]
+    for path in paths:
+        write_file(path, size=40)
+    wiki_mock = mock.MagicMock()
+
+    with mock.patch('attachments.MAX_BATCH_SIZE', 100):
+        attachments.upload_attachments(wiki_mock, '123', paths)
+
+    assert [uploaded_names(put_call) for put_call in wiki_mock.put.call_args_list] == [
+        ['image0.png', 'image1.png'],
+        ['image2.png', 'image3.png'],
+    ]
+    wiki_mock.attach_file.assert_called_once_with(filename='image4.png', page_id='123')
+
+
+def test_same_name_in_different_batches():
+    """Two different images with the same name can't be in the same request"""
+    paths = ['a.png', 'image.png', 'b.png', 'other/image.png', 'c.png']
+    for path in paths:
+        write_file(path)
+    wiki_mock = mock.MagicMock()
+
+    attachments.upload_attachments(wiki_mock, '123', paths)
+
+    # Without the duplicate name, all of them would fit in a single batch
+    assert [uploaded_names(put_call) for put_call in wiki_mock.put.call_args_list] == [
+        ['a.png', 'image.png', 'b.png'],
+        ['image.png', 'c.png'],
+    ]
+    second_batch = wiki_mock.put.call_args_list[1].kwargs['files']
+    assert second_batch[0][1][1].name == 'other/image.png'
+
+
+def test_failed_batch_is_reported():
+    for name in ('a.png', 'b.png'):
+        write_file(name)
+    wiki_mock = mock.MagicMock()
+    wiki_mock.put.side_effect = Exception('Request too large')
+
+    failed = attachments.upload_attachments(wiki_mock, '123', ['a.png', 'b.png'])
+
+    assert failed == ['a.png', 'b.png']
@@ -3,11 +3,20 @@
 e.g. relative links, escaping special JIRA strings"""
 
 import os
+import subprocess
+import threading
 from unittest import mock
 
 import pytest
 
-from content_converter import ContentConverter
+import markdown_renderer
+import profiling
+from content_converter import (
+    ContentConverter,
+    ConversionLimitExceeded,
+    convert_to_jira,
+    render_source,
+)
 
 
 GH_ROOT = 'https://root/github/path/'
@@ -35,6 +44,21 @@ def use_temp_dir(tmp_path):
     os.makedirs('foo/bar')
 
 
+@pytest.fixture(autouse=True, params=['pandoc', 'fast-markdown'])
+def markdown_converter(request):
+    """Runs the tests with Pandoc only, and with the fast Markdown renderer for the
+    files it supports, which must give the same results"""
+    if request.param == 'fast-markdown':
+        yield
+        return
+
+    with mock.patch(
+        'markdown_renderer.render_file',
+        side_effect=markdown_renderer.UnsupportedMarkdown,
+    ):
+        yield
+
+
 @pytest.fixture
 def wiki_mock():
     m = mock.Mock()
@@ -198,6 +222,25 @@ def test_link_to_file_that_exists_on_confluence(wiki_mock):
     )
 
 
+def test_page_lookups_are_profiled_as_upload(wiki_mock):
+    """The requests to Confluence don't count as link rewriting"""
+    write_something_to_file('linked_file.py')
+    doc_path = 'new_doc.md'
+    with open(doc_path, mode='w', encoding='utf-8') as doc_file:
+        print('Check out this [other file](linked_file.py)', file=doc_file)
+
+    lookup_stages = []
+    wiki_mock.get_page_by_title.side_effect = lambda *args: lookup_stages.append(
+        profiling._thread_stages.get(threading.get_ident())
+    )
+
+    converter = ContentConverter(wiki_mock, GH_ROOT, REPO_NAME)
+    with profiling.stage('link rewriting'):
+        converter.convert_file_contents(doc_path)
+
+    assert lookup_stages == ['upload']
+
+
 def test_several_links_on_same_line(wiki_mock):
     # Create file that the doc will link to
     linked_file_name = 'linked_file.py'
@@ -376,6 +419,52 @@ And some more text
     assert output == expected_output
 
 
+@pytest.mark.parametrize('doc_path', ['new_doc.md', 'new_doc.rst'])
+def test_conversion_with_timeout(doc_path):
+    """Pandoc is run differently when the conversion has a timeout, with the same
+    result"""
+    contents = """Some *text*
+
+.. note::
+
+   This is a note
+
+* A list"""
+    with open(doc_path, mode='w', encoding='utf-8') as doc_file:
+        print(contents, file=doc_file)
+
+    assert convert_to_jira(doc_path, timeout=60) == convert_to_jira(doc_path)
+
+    with mock.patch(
+        'subprocess.run', side_effect=subprocess.TimeoutExpired('pandoc', 60)
+    ):
+        with pytest.raises(ConversionLimitExceeded):
+            convert_to_jira(doc_path, timeout=60)
+
+
+def test_conversion_of_large_file():
+    doc_path = 'new_doc.md'
+    with open(doc_path, mode='w', encoding='utf-8') as doc_file:
+        print('Some text', file=doc_file)
+
+    with mock.patch('pypandoc.convert_file') as convert_mock:
+        with pytest.raises(ConversionLimitExceeded):
+            convert_to_jira(doc_path, max_file_size=5)
+    convert_mock.assert_not_called()
+
+
 def write_something_to_file(file_path: str) -> None:
     with open(file_path, mode='w', encoding='utf-8') as doc_file:
         print('Not important - file only needs to exist', file=doc_file)
+
+
+def test_source_with_noformat_block():
+    with open('doc.md', mode='w', encoding='utf-8') as doc_file:
+        print('{noformat}\n[not a link]\n{noformat}', file=doc_file)
+
+    output = render_source('doc.md', 'https://github.com/doc.md')
+
+    assert output == (
+        'This file could not be converted, see [the original|https://github.com/doc.md].'
+        '\n{noformat}\n{\u200bnoformat}\n[not a link]\n{\u200bnoformat}\n{noformat}\n'
+    )
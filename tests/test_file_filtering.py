@@ -62,3 +62,28 @@ def test_several_ignored_folders():
     assert not wiki_sync.should_sync_file('bar/file.md')
 
     assert wiki_sync.should_sync_file('baz/file.md')
+
+
+def test_shards_split_files():
+    os.environ['INPUT_IGNORED-FOLDERS'] = ''
+    files = [f'folder{i % 7}/file{i}.md' for i in range(100)]
+    changed_files = '|'.join(files + ['not_a_doc.py'])
+
+    os.environ['INPUT_SHARD-COUNT'] = '3'
+    shards = []
+    try:
+        for shard_index in range(3):
+            os.environ['INPUT_SHARD-INDEX'] = str(shard_index)
+            shards.append(wiki_sync.get_files_to_sync(changed_files))
+    finally:
+        del os.environ['INPUT_SHARD-COUNT']
+        del os.environ['INPUT_SHARD-INDEX']
+
+    # Each file is synced by exactly one shard
+    assert sorted(f for shard in shards for f in shard) == sorted(files)
+    assert all(shards)
+
+    # The split only depends on the file name
+    assert wiki_sync.is_in_shard('folder1/file1.md', 0, 3) == (
+        'folder1/file1.md' in shards[0]
+    )
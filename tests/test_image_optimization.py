@@ -0,0 +1,88 @@
+"""Tests that images are downsized before being uploaded, and that the result is
+cached"""
+
+import os
+from unittest import mock
+
+import PIL.Image
+import pytest
+
+import image_optimizer
+
+
+@pytest.fixture(autouse=True)
+def use_temp_dir(tmp_path):
+    # tmp_path is the path to a pytest-provided temporary folder
+    # Run the test inside it, so the files it creates are cleaned up afterwards
+    os.chdir(tmp_path)
+
+
+@pytest.fixture(autouse=True)
+def optimization_settings():
+    os.environ['INPUT_IMAGE-MAX-DIMENSION'] = '100'
+    os.environ['INPUT_IMAGE-MAX-FILE-SIZE'] = ''
+    os.environ['INPUT_IMAGE-CACHE-FOLDER'] = 'cache'
+    yield
+    del os.environ['INPUT_IMAGE-MAX-DIMENSION']
+    del os.environ['INPUT_IMAGE-MAX-FILE-SIZE']
+    del os.environ['INPUT_IMAGE-CACHE-FOLDER']
+
+
+def test_large_image_is_downsized():
+    PIL.Image.new('RGB', (400, 200), color='purple').save('big.png')
+
+    upload_path = image_optimizer.file_to_upload('big.png')
+
+    # The attachment keeps the name of the original image
+    assert upload_path != 'big.png'
+    assert os.path.basename(upload_path) == 'big.png'
+    with PIL.Image.open(upload_path) as image:
+        assert image.size == (100, 50)
+        assert image.format == 'PNG'
+
+    # The second time, the cached image is used
+    with mock.patch('PIL.Image.open') as open_mock:
+        assert image_optimizer.file_to_upload('big.png') == upload_path
+    open_mock.assert_not_called()
+
+
+def test_rotated_photo_is_downsized_upright():
+    photo = PIL.Image.new('RGB', (400, 200), color='purple')
+    exif = photo.getexif()
+    exif[0x0112] = 6  # Orientation: rotated 90 degrees
+    photo.save('photo.jpg', exif=exif)
+
+    upload_path = image_optimizer.file_to_upload('photo.jpg')
+
+    with PIL.Image.open(upload_path) as image:
+        assert image.size == (50, 100)
+
+
+def test_animated_image_is_unchanged():
+    frames = [PIL.Image.new('RGB', (400, 200), color) for color in ('red', 'blue')]
+    frames[0].save('animation.webp', save_all=True, append_images=frames[1:])
+
+    assert image_optimizer.file_to_upload('animation.webp') == 'animation.webp'
+
+
+def test_small_image_is_unchanged():
+    PIL.Image.new('RGB', (40, 20), color='purple').save('small.jpg')
+
+    upload_path = image_optimizer.file_to_upload('small.jpg')
+
+    with open(upload_path, mode='rb') as uploaded, open('small.jpg', 'rb') as original:
+        assert uploaded.read() == original.read()
+
+
+def test_other_files_are_unchanged():
+    with open('diagram.svg', mode='w', encoding='utf-8') as svg_file:
+        print('<svg></svg>', file=svg_file)
+
+    assert image_optimizer.file_to_upload('diagram.svg') == 'diagram.svg'
+
+
+def test_optimization_disabled():
+    os.environ['INPUT_IMAGE-MAX-DIMENSION'] = ''
+    PIL.Image.new('RGB', (400, 200), color='purple').save('big.png')
+
+    assert image_optimizer.file_to_upload('big.png') == 'big.png'
@@ -3,10 +3,12 @@ End-to-end tests that make sure the correct Confluence pages are
 created/updated, and with the correct content
 """
 
+import json
 import os
 from unittest import mock
 
 import pytest
+import requests
 
 import wiki_sync
 
@@ -141,6 +143,735 @@ def test_new_image_attachment_to_existing_page(use_temp_dir, wiki_mock):
     )
 
 
+def test_images_uploaded_once_to_shared_assets_page(use_temp_dir, wiki_mock):
+    """An image used by several files is attached once, to the shared assets page"""
+    os.makedirs('images', exist_ok=True)
+    with open('images/logo.png', mode='w', encoding='utf-8') as image:
+        print('foobar', file=image)
+    for file_path in ('hello.md', 'foo/other.md'):
+        with open(file_path, mode='w', encoding='utf-8') as doc_file:
+            image_path = os.path.relpath('images/logo.png', os.path.dirname(file_path))
+            print(f'![Logo]({image_path})', file=doc_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: {
+        'My docs': 12345,
+        'repo/foo': 23456,
+    }.get(title)
+    wiki_mock.create_page.return_value = {'id': '999'}
+    wiki_mock.get_attachments_from_content.return_value = {'results': []}
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_SHARED-ASSETS'] = 'true'
+
+    assert wiki_sync.sync_files(['hello.md', 'foo/other.md'])
+
+    assert wiki_mock.create_page.call_args.kwargs['title'] == 'repo assets'
+    assert wiki_mock.create_page.call_args.kwargs['parent_id'] == 12345
+    wiki_mock.attach_file.assert_not_called()
+    wiki_mock.put.assert_called_once()
+    assert wiki_mock.put.call_args.args == ('rest/api/content/999/child/attachment',)
+    ((_, (attachment_name, _, _)),) = wiki_mock.put.call_args.kwargs['files']
+    assert attachment_name.endswith('-logo.png')
+    for update_call in wiki_mock.update_or_create.call_args_list:
+        assert f'!repo assets^{attachment_name}|' in update_call.kwargs['body']
+
+
+def test_shared_assets_page_outside_of_root(use_temp_dir, wiki_mock):
+    """Another page has the title of the shared assets page, so it can't be used"""
+    os.makedirs('images', exist_ok=True)
+    with open('images/logo.png', mode='w', encoding='utf-8') as image:
+        print('foobar', file=image)
+    with open('hello.md', mode='w', encoding='utf-8') as doc_file:
+        print('![Logo](images/logo.png)', file=doc_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: {
+        'My docs': 12345,
+        'repo/hello.md': 678,
+        'repo assets': 999,
+    }.get(title)
+    wiki_mock.get_page_by_id.return_value = {'ancestors': [{'id': '11111'}]}
+    wiki_mock.get_attachments_from_content.return_value = {'results': []}
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_SHARED-ASSETS'] = 'true'
+
+    assert wiki_sync.sync_files(['hello.md'])
+
+    wiki_mock.get_page_by_id.assert_called_once_with(999, expand='ancestors')
+    wiki_mock.create_page.assert_not_called()
+    # The image is attached to the page using it instead
+    wiki_mock.attach_file.assert_called_once()
+    assert wiki_mock.attach_file.call_args.kwargs['page_id'] == 678
+
+
+def test_shared_assets_page_not_created(use_temp_dir, wiki_mock):
+    """A 400 from the creation of the shared assets page doesn't mean that the page
+    exists, so the sync fails unless it can be found"""
+    with open('hello.md', mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: {
+        'My docs': 12345,
+    }.get(title)
+    wiki_mock.create_page.side_effect = requests.HTTPError(
+        'Invalid parent page', response=mock.Mock(status_code=400)
+    )
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_SHARED-ASSETS'] = 'true'
+
+    with pytest.raises(requests.HTTPError, match='Invalid parent page'):
+        wiki_sync.sync_files(['hello.md'])
+
+    # The page was created concurrently under the root page, so it is used
+    wiki_mock.get_page_id.side_effect = [12345, None, 999]
+    wiki_mock.get_page_by_id.return_value = {'ancestors': [{'id': '12345'}]}
+    wiki_mock.get_attachments_from_content.return_value = {'results': []}
+
+    assert wiki_sync.sync_files(['hello.md'])
+
+    wiki_mock.get_page_by_id.assert_called_once_with(999, expand='ancestors')
+    wiki_mock.get_attachments_from_content.assert_called()
+    assert wiki_mock.get_attachments_from_content.call_args.args[0] == 999
+
+
+def test_backlinks_updated_when_page_is_created(use_temp_dir, wiki_mock):
+    """Pages synced in a previous run that link to a file through GitHub are updated
+    once the file gets its own page"""
+    with open('old.md', mode='w', encoding='utf-8') as old_file:
+        print('See [the new doc](new.md)', file=old_file)
+    with open('new.md', mode='w', encoding='utf-8') as new_file:
+        print('Hello, World', file=new_file)
+
+    # The link graph remembers that old.md linked to new.md through GitHub
+    graph_path = 'link-graph.json'
+    with open(graph_path, mode='w', encoding='utf-8') as graph_file:
+        json.dump({'old.md': {'new.md': False}}, graph_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    wiki_mock.get_page_by_title.return_value = {
+        '_links': {'webui': '/spaces/SPACE/pages/678'}
+    }
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_LINK-GRAPH-FILE'] = graph_path
+
+    assert wiki_sync.sync_files(['new.md'])
+
+    titles = [c.kwargs['title'] for c in wiki_mock.update_or_create.call_args_list]
+    assert titles == ['repo/new.md', 'repo/old.md']
+    assert (
+        '/wiki/spaces/SPACE/pages/678'
+        in (wiki_mock.update_or_create.call_args_list[1].kwargs['body'])
+    )
+
+    with open(graph_path, encoding='utf-8') as graph_file:
+        assert json.load(graph_file) == {'new.md': {}, 'old.md': {'new.md': True}}
+
+
+def test_links_between_new_files(use_temp_dir, wiki_mock):
+    """A file linking to a file that's new in the same run links to its page"""
+    with open('first.md', mode='w', encoding='utf-8') as first_file:
+        print('See [the second doc](foo/second.md)', file=first_file)
+    with open('foo/second.md', mode='w', encoding='utf-8') as second_file:
+        print('Hello, World', file=second_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: {
+        'My docs': 12345,
+        'repo/foo': 23456,
+    }.get(title)
+    wiki_mock.get_page_by_title.return_value = None
+    wiki_mock.create_page.return_value = {
+        'id': '678',
+        'version': {'number': 1},
+        '_links': {'webui': '/spaces/SPACE/pages/678'},
+    }
+    wiki_mock.put.return_value = {'id': '678', 'version': {'number': 2}}
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    assert wiki_sync.sync_files(['first.md', 'foo/second.md'])
+
+    # The linked page is created first, then written with its contents
+    wiki_mock.get_page_by_title.assert_called_once_with(
+        'SPACE', 'repo/foo/second.md', expand='version'
+    )
+    assert wiki_mock.create_page.call_args.kwargs['parent_id'] == 23456
+    assert wiki_mock.put.call_args.kwargs['data']['version']['number'] == 2
+    wiki_mock.update_or_create.assert_called_once()
+    assert (
+        '[the second doc|/wiki/spaces/SPACE/pages/678]'
+        in wiki_mock.update_or_create.call_args.kwargs['body']
+    )
+
+
+def test_linked_page_created_with_source(use_temp_dir, wiki_mock):
+    """The page created ahead of its contents shows the source of its file, in case
+    the file isn't synced, e.g. because its upload fails or the job is cancelled"""
+    with open('first.md', mode='w', encoding='utf-8') as first_file:
+        print('See [the second doc](foo/second.md)', file=first_file)
+    with open('foo/second.md', mode='w', encoding='utf-8') as second_file:
+        print('Hello, World', file=second_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: {
+        'My docs': 12345,
+        'repo/foo': 23456,
+    }.get(title)
+    wiki_mock.get_page_by_title.return_value = None
+    wiki_mock.create_page.return_value = {
+        'id': '678',
+        'version': {'number': 1},
+        '_links': {'webui': '/spaces/SPACE/pages/678'},
+    }
+    wiki_mock.put.side_effect = requests.HTTPError(response=mock.Mock(status_code=500))
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    assert not wiki_sync.sync_files(['first.md', 'foo/second.md'])
+
+    body = wiki_mock.create_page.call_args.kwargs['body']
+    assert 'This file was not synced yet, see [the original|' in body
+    assert '{noformat}\nHello, World\n{noformat}' in body
+    # The linked file is synced first. Its write fails, but the page is kept.
+    assert wiki_mock.put.call_args.args == ('rest/api/content/678',)
+    wiki_mock.remove_page.assert_not_called()
+    assert (
+        '[the second doc|/wiki/spaces/SPACE/pages/678]'
+        in wiki_mock.update_or_create.call_args.kwargs['body']
+    )
+
+
+def test_known_page_is_updated_directly(use_temp_dir, wiki_mock):
+    file_name = 'hello.md'
+    with open(file_name, mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    wiki_mock.put.return_value = {'id': '678', 'version': {'number': 4}}
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    known_page = wiki_sync.KnownPage(page_id='678', version=3)
+    assert wiki_sync.sync_files(
+        [file_name], known_pages={('SPACE', file_name): known_page}
+    )
+
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.put.assert_called_once()
+    assert wiki_mock.put.call_args.args == ('rest/api/content/678',)
+    data = wiki_mock.put.call_args.kwargs['data']
+    assert data['version']['number'] == 4
+    assert data['title'] == f'repo/{file_name}'
+    assert data['ancestors'] == [{'type': 'page', 'id': 12345}]
+    assert known_page.version == 4
+
+
+def test_written_pages_are_known_by_next_sync(use_temp_dir, wiki_mock):
+    file_name = 'hello.md'
+    with open(file_name, mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    wiki_mock.update_or_create.return_value = {'id': '678', 'version': {'number': 1}}
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    known_pages = {}
+    assert wiki_sync.sync_files([file_name], known_pages=known_pages)
+    assert known_pages == {('SPACE', file_name): wiki_sync.KnownPage('678', 1)}
+
+    wiki_mock.reset_mock()
+    wiki_mock.get_page_id.return_value = 12345
+    wiki_mock.put.return_value = {'id': '678', 'version': {'number': 2}}
+    assert wiki_sync.sync_files([file_name], known_pages=known_pages)
+
+    wiki_mock.update_or_create.assert_not_called()
+    assert wiki_mock.put.call_args.kwargs['data']['version']['number'] == 2
+    assert known_pages[('SPACE', file_name)].version == 2
+
+
+def test_known_page_version_conflict(use_temp_dir, wiki_mock):
+    """If the known version is outdated, the update is retried with the current one"""
+    conflict = requests.HTTPError(response=mock.Mock(status_code=409))
+    wiki_mock.put.side_effect = [conflict, {'id': '678', 'version': {'number': 6}}]
+    wiki_mock.get_page_by_id.return_value = {'version': {'number': 5}}
+
+    known_page = wiki_sync.KnownPage(page_id='678', version=3)
+    wiki_sync.update_page_with_version(wiki_mock, known_page, 12345, 'title', 'body')
+
+    wiki_mock.get_page_by_id.assert_called_once_with('678', expand='version')
+    versions = [
+        c.kwargs['data']['version']['number'] for c in wiki_mock.put.call_args_list
+    ]
+    assert versions == [4, 6]
+    assert known_page.version == 6
+
+
+def test_sync_to_several_targets(use_temp_dir, wiki_mock):
+    """Files are converted once, and uploaded under each target's root page"""
+    file_name = 'hello.md'
+    with open(file_name, mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    root_page_ids = {('SPACE', 'My docs'): 1, ('PARTNER', 'Shared: docs'): 2}
+    wiki_mock.get_page_id.side_effect = lambda space, title: root_page_ids[
+        (space, title)
+    ]
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_ADDITIONAL-TARGETS'] = '\nPARTNER:Shared: docs\n'
+
+    with mock.patch(
+        'content_converter.convert_to_jira', return_value='Hello, World\n'
+    ) as convert_mock:
+        assert wiki_sync.sync_files([file_name])
+
+    convert_mock.assert_called_once()
+    parent_ids = sorted(
+        c.kwargs['parent_id'] for c in wiki_mock.update_or_create.call_args_list
+    )
+    assert parent_ids == [1, 2]
+
+
+@pytest.mark.parametrize(
+    'additional_targets', ['no separator', 'SPACE:Docs archive', 'A:Docs\nA:Archive']
+)
+def test_invalid_additional_target(additional_targets):
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_ADDITIONAL-TARGETS'] = additional_targets
+
+    with pytest.raises(ValueError):
+        wiki_sync.get_sync_targets()
+
+
+def test_folder_page_created_concurrently(use_temp_dir, wiki_mock):
+    """Another job created the folder page between our lookup and our creation"""
+    file_name = 'foo/hello.md'
+    with open(file_name, mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    # Root page exists, folder page doesn't, then it does
+    wiki_mock.get_page_id.side_effect = [12345, None, 67890]
+    already_exists = requests.HTTPError(
+        'A page with this title already exists', response=mock.Mock(status_code=400)
+    )
+    wiki_mock.create_page.side_effect = already_exists
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    assert wiki_sync.sync_files([file_name])
+
+    wiki_mock.create_page.assert_called_once()
+    wiki_mock.update_or_create.assert_called_once()
+    assert wiki_mock.update_or_create.call_args.kwargs['parent_id'] == 67890
+
+
+def test_missing_folder_pages_created_once(use_temp_dir, wiki_mock):
+    files = ['foo/a.md', 'foo/bar/b.md', 'foo/bar/c.md', 'baz/d.md']
+    os.makedirs('baz')
+    for file_name in files:
+        with open(file_name, mode='w', encoding='utf-8') as doc_file:
+            print('Hello, World', file=doc_file)
+
+    # Only the root page exists
+    wiki_mock.get_page_id.side_effect = lambda space, title: (
+        12345 if title == 'My docs' else None
+    )
+    wiki_mock.create_page.side_effect = lambda **kwargs: {'id': f'id-{kwargs["title"]}'}
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    assert wiki_sync.sync_files(files)
+
+    created_pages = {
+        c.kwargs['title']: c.kwargs['parent_id']
+        for c in wiki_mock.create_page.call_args_list
+    }
+    assert created_pages == {
+        'repo/foo': 12345,
+        'repo/baz': 12345,
+        'repo/foo/bar': 'id-repo/foo',
+    }
+    assert wiki_mock.create_page.call_count == 3
+
+    parent_ids = {
+        c.kwargs['title']: c.kwargs['parent_id']
+        for c in wiki_mock.update_or_create.call_args_list
+    }
+    assert parent_ids == {
+        'repo/foo/a.md': 'id-repo/foo',
+        'repo/foo/bar/b.md': 'id-repo/foo/bar',
+        'repo/foo/bar/c.md': 'id-repo/foo/bar',
+        'repo/baz/d.md': 'id-repo/baz',
+    }
+
+
+@pytest.mark.parametrize('mode', ['dry-run', 'delete', 'archive'])
+def test_reconcile_orphaned_pages(use_temp_dir, wiki_mock, mode):
+    with open('foo/a.md', mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    titles = [
+        'repo/foo',
+        'repo/foo/a.md',
+        'repo/foo/bar',  # Folder without any doc file
+        'repo/old.md',
+        'repo/gone',
+        'repo/gone/b.md',
+        'Not synced from the repo',
+    ]
+    search_results = [
+        {
+            'id': f'id-{title}',
+            'title': title,
+            'version': {'number': 1},
+            '_links': {'webui': f'/pages/{title}'},
+        }
+        for title in titles
+    ]
+    # The search results come in two chunks
+    wiki_mock.get.side_effect = [
+        {'results': search_results[:3], '_links': {'next': '/next?cursor=abc'}},
+        {'results': search_results[3:], '_links': {}},
+    ]
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    # Most of the pages are orphaned
+    os.environ['INPUT_RECONCILE-FORCE'] = 'true'
+
+    assert wiki_sync.reconcile_pages(mode)
+
+    assert wiki_mock.get.call_args_list[1].args == ('next?cursor=abc',)
+    deleted_ids = [c.args[0] for c in wiki_mock.remove_page.call_args_list]
+    archive_calls = wiki_mock.post.call_args_list
+    # Deepest pages first
+    orphaned_ids = [
+        'id-repo/foo/bar',
+        'id-repo/gone/b.md',
+        'id-repo/gone',
+        'id-repo/old.md',
+    ]
+    if mode == 'dry-run':
+        assert not deleted_ids
+        assert not archive_calls
+    elif mode == 'delete':
+        # Pages of the same batch are deleted concurrently
+        assert sorted(deleted_ids) == sorted(orphaned_ids)
+    else:
+        assert len(archive_calls) == 1
+        archived_pages = archive_calls[0].kwargs['data']['pages']
+        assert [page['id'] for page in archived_pages] == orphaned_ids
+
+
+@pytest.mark.parametrize('mode', ['dry-run', 'delete'])
+def test_reconcile_prunes_unused_shared_assets(use_temp_dir, wiki_mock, mode):
+    for file_path in ('a.md', 'c.md'):
+        with open(file_path, mode='w', encoding='utf-8') as doc_file:
+            print('Hello, World', file=doc_file)
+
+    used_image = '0123456789abcdef-logo.png'
+    escaped_image = 'aaaaaaaaaaaaaaaa-R&D.png'
+    old_image = 'fedcba9876543210-logo.png'
+    bodies = {
+        'repo/a.md': f'<ri:attachment ri:filename="{used_image}" />',
+        'repo/b.md': f'<ri:attachment ri:filename="{old_image}" />',  # Orphaned
+        'repo/c.md': '<ri:attachment ri:filename="aaaaaaaaaaaaaaaa-R&amp;D.png" />',
+        'repo assets': '',
+    }
+    wiki_mock.get.return_value = {
+        'results': [
+            {
+                'id': f'id-{title}',
+                'title': title,
+                'version': {'number': 1},
+                '_links': {'webui': f'/pages/{title}'},
+                'body': {'storage': {'value': body}},
+            }
+            for title, body in bodies.items()
+        ]
+    }
+    wiki_mock.get_attachments_from_content.return_value = {
+        'results': [
+            {'title': used_image},
+            {'title': escaped_image},
+            {'title': old_image},
+            {'title': 'uploaded-by-hand.pdf'},
+        ]
+    }
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_SHARED-ASSETS'] = 'true'
+
+    assert wiki_sync.reconcile_pages(mode)
+
+    assert wiki_mock.get.call_args.kwargs['params']['expand'] == 'version,body.storage'
+    wiki_mock.get_attachments_from_content.assert_called_once_with(
+        'id-repo assets', start=0, limit=200
+    )
+    if mode == 'dry-run':
+        wiki_mock.delete_attachment.assert_not_called()
+    else:
+        wiki_mock.delete_attachment.assert_called_once_with('id-repo assets', old_image)
+
+
+def test_reconcile_with_shards_does_not_prune_shared_assets(use_temp_dir, wiki_mock):
+    """Other shards may be uploading images for pages they haven't written yet"""
+    with open('a.md', mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get.return_value = {
+        'results': [
+            {
+                'id': 'id-repo assets',
+                'title': 'repo assets',
+                'version': {'number': 1},
+                '_links': {'webui': '/pages/assets'},
+            }
+        ]
+    }
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_SHARED-ASSETS'] = 'true'
+    os.environ['INPUT_SHARD-COUNT'] = '2'
+
+    assert wiki_sync.reconcile_pages('delete')
+
+    wiki_mock.get_attachments_from_content.assert_not_called()
+    wiki_mock.delete_attachment.assert_not_called()
+
+
+@pytest.mark.parametrize('doc_files', [[], ['foo/a.md']])
+def test_reconcile_refuses_to_remove_most_pages(use_temp_dir, wiki_mock, doc_files):
+    for doc_file_path in doc_files:
+        with open(doc_file_path, mode='w', encoding='utf-8') as doc_file:
+            print('Hello, World', file=doc_file)
+
+    wiki_mock.get.return_value = {
+        'results': [
+            {
+                'id': f'id-{title}',
+                'title': title,
+                'version': {'number': 1},
+                '_links': {'webui': f'/pages/{title}'},
+            }
+            for title in [
+                'repo/foo',
+                'repo/foo/a.md',
+                'repo/b.md',
+                'repo/c.md',
+                'repo/d.md',
+            ]
+        ],
+        '_links': {},
+    }
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+
+    assert not wiki_sync.reconcile_pages('delete')
+
+    wiki_mock.remove_page.assert_not_called()
+
+
+def test_manifest_avoids_lookups_and_unchanged_writes(use_temp_dir, wiki_mock):
+    file_path = 'hello.md'
+    attachment_path = 'images/some-image.jpg'
+    with open(file_path, mode='w', encoding='utf-8') as doc_file:
+        print(f'![A cool image]({attachment_path})', file=doc_file)
+    os.makedirs('images')
+    with open(attachment_path, mode='w', encoding='utf-8') as attachment:
+        print('foobar', file=attachment)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: (
+        12345 if title == 'My docs' else None
+    )
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_MANIFEST-FILE'] = '.wiki-sync/manifest.json'
+
+    # First run: the page isn't listed, so it is created without being looked up
+    wiki_mock.get.return_value = {'results': []}
+    wiki_mock.create_page.return_value = {'id': '678', 'version': {'number': 1}}
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.get_page_id.assert_called_once_with('SPACE', 'My docs')
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.create_page.assert_called_once()
+    wiki_mock.attach_file.assert_called_once()
+
+    # Second run: nothing changed, so nothing is looked up or uploaded
+    wiki_mock.reset_mock()
+    wiki_mock.get.return_value = {
+        'results': [
+            {
+                'id': '678',
+                'title': f'repo/{file_path}',
+                'version': {'number': 1},
+                '_links': {'webui': '/pages/678'},
+            }
+        ]
+    }
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.get_page_id.assert_called_once_with('SPACE', 'My docs')
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.put.assert_not_called()
+    wiki_mock.attach_file.assert_not_called()
+    wiki_mock.get_attachments_from_content.assert_not_called()
+
+    # Third run: the image changed, so only the image is uploaded again. The page
+    # refers to it by name, so its body is unchanged and it isn't written.
+    wiki_mock.reset_mock()
+    with open(attachment_path, mode='w', encoding='utf-8') as attachment:
+        print('new foobar', file=attachment)
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.put.assert_not_called()
+    wiki_mock.attach_file.assert_called_once()
+
+    # Fourth run: the file changed, so the page is updated with its known version
+    wiki_mock.reset_mock()
+    wiki_mock.put.return_value = {'id': '678', 'version': {'number': 2}}
+    with open(file_path, mode='a', encoding='utf-8') as doc_file:
+        print('More text', file=doc_file)
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.update_or_create.assert_not_called()
+    assert wiki_mock.put.call_args.kwargs['data']['version']['number'] == 2
+
+
+def test_pages_looked_up_when_listing_fails(use_temp_dir, wiki_mock):
+    file_path = 'foo/hello.md'
+    with open(file_path, mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.side_effect = lambda space, title: (
+        12345 if title == 'My docs' else 67890
+    )
+    wiki_mock.get.side_effect = requests.HTTPError('Search is down')
+    wiki_mock.update_or_create.return_value = {'id': '678', 'version': {'number': 1}}
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_MANIFEST-FILE'] = '.wiki-sync/manifest.json'
+
+    assert wiki_sync.sync_files([file_path])
+
+    wiki_mock.get_page_id.assert_any_call('SPACE', 'repo/foo')
+    wiki_mock.create_page.assert_not_called()
+    assert wiki_mock.update_or_create.call_args.kwargs['parent_id'] == 67890
+
+
+def test_resume_interrupted_sync(use_temp_dir, wiki_mock):
+    """The previous run for this commit wrote the page but was interrupted before
+    uploading its attachments"""
+    file_path = 'hello.md'
+    attachment_path = 'images/some-image.jpg'
+    with open(file_path, mode='w', encoding='utf-8') as doc_file:
+        print(f'![A cool image]({attachment_path})', file=doc_file)
+    os.makedirs('images')
+    with open(attachment_path, mode='w', encoding='utf-8') as attachment:
+        print('foobar', file=attachment)
+
+    journal_path = 'journal.jsonl'
+    with open(journal_path, mode='w', encoding='utf-8') as journal_file:
+        for step, space, details in [
+            ('converted', '', {'contents': '!some-image.jpg!'}),
+            (
+                'page-written',
+                'SPACE',
+                {
+                    'page_id': '678',
+                    'resolved_links': {},
+                    'attachments': [attachment_path],
+                },
+            ),
+        ]:
+            entry = {
+                'commit': 'abc123',
+                'step': step,
+                'file': file_path,
+                'space': space,
+                'details': details,
+            }
+            print(json.dumps(entry), file=journal_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_JOURNAL-FILE'] = journal_path
+    os.environ['GITHUB_SHA'] = 'abc123'
+
+    with mock.patch('pypandoc.convert_file') as convert_mock:
+        assert wiki_sync.sync_files([file_path])
+
+    convert_mock.assert_not_called()
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.attach_file.assert_called_once_with(
+        filename=attachment_path, page_id='678'
+    )
+
+    # Running again does nothing
+    wiki_mock.reset_mock()
+    wiki_mock.get_page_id.return_value = 12345
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.update_or_create.assert_not_called()
+    wiki_mock.attach_file.assert_not_called()
+
+    # A new commit starts from scratch
+    os.environ['GITHUB_SHA'] = 'def456'
+    wiki_mock.update_or_create.return_value = {'id': '678'}
+    assert wiki_sync.sync_files([file_path])
+    wiki_mock.update_or_create.assert_called_once()
+
+
+def test_time_budget_exceeded(use_temp_dir, wiki_mock):
+    with open('hello.md', mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_TIME-BUDGET'] = '0.000001'
+
+    assert not wiki_sync.sync_files(['hello.md'])
+    wiki_mock.update_or_create.assert_not_called()
+
+
+def test_targets_and_conversions_reused(use_temp_dir, wiki_mock):
+    """Successive syncs of the daemon don't set the targets up or convert unchanged
+    files again"""
+    with open('hello.md', mode='w', encoding='utf-8') as doc_file:
+        print('Hello, World', file=doc_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    target_runs = wiki_sync.create_target_runs()
+    conversion_cache = {}
+
+    for _ in range(2):
+        wiki_mock.reset_mock()
+        with mock.patch(
+            'pypandoc.convert_file', return_value='Hello, World'
+        ) as convert_mock:
+            assert wiki_sync.sync_files(
+                ['hello.md'],
+                target_runs=target_runs,
+                conversion_cache=conversion_cache,
+            )
+        wiki_mock.update_or_create.assert_called_once()
+
+    convert_mock.assert_not_called()
+    wiki_mock.get_page_id.assert_not_called()
+
+
+def test_file_too_large_to_convert(use_temp_dir, wiki_mock):
+    """A file that's too large is synced as source code, and listed in the summary"""
+    with open('huge.md', mode='w', encoding='utf-8') as doc_file:
+        print('| A huge table |\n' * 100, file=doc_file)
+
+    wiki_mock.get_page_id.return_value = 12345
+    set_up_dummy_environment('SPACE', 'My docs')
+    os.environ['INPUT_MAX-FILE-SIZE'] = '1'
+    os.environ['GITHUB_STEP_SUMMARY'] = 'summary.md'
+
+    with mock.patch('pypandoc.convert_file') as convert_mock:
+        assert wiki_sync.sync_files(['huge.md'])
+
+    convert_mock.assert_not_called()
+    body = wiki_mock.update_or_create.call_args.kwargs['body']
+    assert '[the original|https://github.com/owner/repo/blob/main/huge.md]' in body
+    assert '{noformat}\n| A huge table |\n' in body
+    # Only the first KB of the source is included
+    assert body.count('| A huge table |') == 1024 // len('| A huge table |\n')
+    assert (
+        'The file is truncated, [view the full file|'
+        'https://github.com/owner/repo/blob/main/huge.md]'
+    ) in body
+    with open('summary.md', encoding='utf-8') as summary_file:
+        assert '`huge.md`: huge.md is larger than 1024 bytes' in summary_file.read()
+
+
 def test_root_does_not_exist(wiki_mock):
     """#11"""
     set_up_dummy_environment('SPACE', 'My docs')
@@ -153,6 +884,18 @@ def test_root_does_not_exist(wiki_mock):
 
 
 def set_up_dummy_environment(space_name: str, root_page_title: str) -> None:
+    os.environ['INPUT_ADDITIONAL-TARGETS'] = ''
+    os.environ['INPUT_IGNORED-FOLDERS'] = ''
+    os.environ['INPUT_LINK-GRAPH-FILE'] = ''
+    os.environ['INPUT_MANIFEST-FILE'] = ''
+    os.environ['INPUT_JOURNAL-FILE'] = ''
+    os.environ['INPUT_TIME-BUDGET'] = ''
+    os.environ['INPUT_CONVERSION-TIMEOUT'] = ''
+    os.environ['INPUT_MAX-FILE-SIZE'] = ''
+    os.environ['INPUT_SHARED-ASSETS'] = ''
+    os.environ['INPUT_RECONCILE-FORCE'] = ''
+    os.environ['INPUT_SHARD-COUNT'] = ''
+    os.environ['GITHUB_STEP_SUMMARY'] = ''
     os.environ['GITHUB_REPOSITORY'] = 'owner/repo'
     os.environ['INPUT_DEFAULT-GIT-BRANCH'] = 'main'
     os.environ['INPUT_ROOT-PAGE-TITLE'] = root_page_title
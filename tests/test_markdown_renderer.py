@@ -0,0 +1,95 @@
+"""Tests that the fast Markdown renderer gives the same results as Pandoc, and leaves
+the files it doesn't support to Pandoc"""
+
+from unittest import mock
+
+import pypandoc
+import pytest
+
+import markdown_renderer
+from content_converter import convert_to_jira
+
+
+@pytest.mark.parametrize(
+    'markdown',
+    [
+        '',
+        '# Title\n\nSome text\n',
+        '# Same title\n\n## Same title\n\n# 1 Numbered, title!\n\n## 123\n',
+        'A paragraph\nwrapped over\n  several lines\n',
+        'Some *emphasis*, __strong__ text and `inline code`\n',
+        '**A _nested_ one** and *another*\n',
+        'snake_case, __init__ and a lone * star\n',
+        "It's a [link](https://example.org/a?b=c&d=e) to [docs](docs/a.md#section)\n",
+        'Links to themselves: [a.md](a.md) and [`b.md`](b.md)\n',
+        'An image ![](img/a.png) and ![A diagram](https://example.org/b.svg)\n',
+        'Special chars: a-b -c d- (e) x+y +z {y} a!b c! a?b a:b c; a&b &c\n',
+        'The ${SOME_VARIABLE} is 100%, see #12 and a/b=c\n',
+        '`x{y}` `[1]` `-v` `C:/x` `(x)`\n',
+        '- One\n- Two\n  - Nested\n    - Deeper\n- Three\n',
+        '* A\n* list item\n  continued\n\nAfter the list\n',
+        '1. First\n2. Second\n   - Nested\n3. Third\n',
+        '1) One\n2) Two\n',
+        '```\nplain code\n\n```\n\n```python\nprint("Hello")\n```\n',
+        'Text\n```bash\necho $HOME\n```\nMore text\n',
+        '~~~~\n```\nnested fence\n```\n~~~~\n',
+    ],
+)
+def test_same_output_as_pandoc(markdown):
+    assert markdown_renderer.render(markdown) == pypandoc.convert_text(
+        markdown, 'jira', format='markdown'
+    )
+
+
+@pytest.mark.parametrize(
+    'markdown',
+    [
+        'Title\n=====\n',
+        '| a | b |\n|---|---|\n| 1 | 2 |\n',
+        '> A quote\n',
+        '<div>HTML</div>\n',
+        'A footnote[^1]\n\n[^1]: Note\n',
+        '[A reference][ref]\n\n[ref]: https://example.org\n',
+        '---\n',
+        '    Indented code\n',
+        'An \\*escape\n',
+        'A hard  \nline break\n',
+        '"Smart" quotes -- and dashes...\n',
+        'e.g. an abbreviation\n',
+        'Some $math$\n',
+        'H~2~O and x^2^\n',
+        'A f(x) call\n',
+        'Intra*word*emphasis\n',
+        '- A loose\n\n- list\n',
+        '- Mixed\n* markers\n',
+        '[Link](url "with a title")\n',
+        '## A `code` heading\n',
+        '```{.python}\nx = 1\n```\n',
+        '```objective-c\nx\n```\n',
+        'A paragraph\n- that is not a list\n',
+    ],
+)
+def test_unsupported_markdown(markdown):
+    with pytest.raises(markdown_renderer.UnsupportedMarkdown):
+        markdown_renderer.render(markdown)
+
+
+@pytest.mark.parametrize(
+    'contents, pandoc_calls',
+    [('Simple *text*\n', 0), ('> A quote\n', 1)],
+)
+def test_fallback_to_pandoc(tmp_path, contents, pandoc_calls):
+    doc_path = tmp_path / 'doc.md'
+    doc_path.write_text(contents, encoding='utf-8')
+
+    with mock.patch(
+        'pypandoc.convert_file', side_effect=pypandoc.convert_file
+    ) as convert_mock:
+        assert convert_to_jira(str(doc_path)) == pypandoc.convert_text(
+            contents, 'jira', format='markdown'
+        )
+    assert convert_mock.call_count == pandoc_calls
+
+    with mock.patch('pypandoc.convert_file', return_value='') as convert_mock:
+        convert_to_jira(str(doc_path), fast_markdown=False)
+    convert_mock.assert_called_once()
@@ -0,0 +1,51 @@
+"""Tests that the profiler groups its samples by stage"""
+
+import os
+import threading
+import time
+
+import profiling
+
+
+def busy_converting(duration: float) -> None:
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        pass
+
+
+def test_samples_grouped_by_stage(tmp_path):
+    def upload_in_worker_thread():
+        with profiling.stage('upload'):
+            time.sleep(0.1)
+
+    with profiling.Profiler(sampling_interval=0.001) as profiler:
+        with profiling.stage('conversion'):
+            busy_converting(0.1)
+
+        worker = threading.Thread(target=upload_in_worker_thread)
+        worker.start()
+        worker.join()
+
+    profiler.save(tmp_path)
+
+    assert {
+        'profile.prof',
+        'profile-summary.txt',
+        'profile.collapsed',
+        'profile-conversion.collapsed',
+        'profile-upload.collapsed',
+    } <= set(os.listdir(tmp_path))
+
+    with open(tmp_path / 'profile-conversion.collapsed', encoding='utf-8') as f:
+        conversion_stacks = f.read()
+    assert 'busy_converting (test_profiling.py' in conversion_stacks
+    assert all(
+        line.startswith('conversion;') for line in conversion_stacks.splitlines()
+    )
+
+    # Samples are also taken in other threads
+    with open(tmp_path / 'profile-upload.collapsed', encoding='utf-8') as f:
+        assert 'upload_in_worker_thread' in f.read()
+
+    # Stages are forgotten when they end
+    assert not profiling._thread_stages
@@ -0,0 +1,219 @@
+"""Tests that the daemon syncs the files changed by the pushes to the default branch"""
+
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import pytest
+
+import sync_daemon
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ['git', *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit_file(file_name: str, contents: str) -> None:
+    with open(file_name, mode='w', encoding='utf-8') as committed_file:
+        print(contents, file=committed_file)
+    git('add', file_name)
+    git('commit', '--quiet', '-m', f'Update {file_name}')
+
+
+@pytest.fixture
+def clone(tmp_path, monkeypatch):
+    """A clone of a repository, and a second clone to push to it"""
+    for name, value in {
+        'INPUT_DEFAULT-GIT-BRANCH': 'main',
+        'INPUT_IGNORED-FOLDERS': '',
+        'GIT_AUTHOR_NAME': 'Test',
+        'GIT_AUTHOR_EMAIL': 'test@example.com',
+        'GIT_COMMITTER_NAME': 'Test',
+        'GIT_COMMITTER_EMAIL': 'test@example.com',
+    }.items():
+        monkeypatch.setenv(name, value)
+
+    origin = tmp_path / 'origin'
+    git('init', '--quiet', '--bare', '--initial-branch=main', str(origin))
+    git('clone', '--quiet', str(origin), str(tmp_path / 'pusher'))
+    monkeypatch.chdir(tmp_path / 'pusher')
+    commit_file('README.md', 'Hello')
+    git('push', '--quiet', 'origin', 'main')
+
+    git('clone', '--quiet', str(origin), str(tmp_path / 'clone'))
+    return tmp_path
+
+
+def push_file(repo_root, file_name: str, contents: str) -> None:
+    os.chdir(repo_root / 'pusher')
+    commit_file(file_name, contents)
+    git('push', '--quiet', 'origin', 'main')
+    os.chdir(repo_root / 'clone')
+
+
+def test_pushes_are_synced_together(clone):
+    os.chdir(clone / 'clone')
+    daemon = sync_daemon.SyncDaemon()
+
+    push_file(clone, 'README.md', 'Hello again')
+    push_file(clone, 'docs.md', 'Some docs')
+    push_file(clone, 'script.py', 'print()')
+
+    with (
+        mock.patch('wiki_sync.create_target_runs') as create_mock,
+        mock.patch('wiki_sync.sync_files', return_value=True) as sync_mock,
+    ):
+        assert daemon.sync_pushed_changes()
+
+    create_mock.assert_called_once()
+    sync_mock.assert_called_once_with(
+        ['README.md', 'docs.md'],
+        known_pages=daemon.known_pages,
+        target_runs=create_mock.return_value,
+        conversion_cache=daemon.conversion_cache,
+    )
+    assert daemon.last_synced_commit == git('rev-parse', 'HEAD')
+    with open('docs.md', encoding='utf-8') as docs_file:
+        assert docs_file.read() == 'Some docs\n'
+
+    # The next sync reuses the targets, and only syncs what changed since
+    push_file(clone, 'docs.md', 'More docs')
+    with (
+        mock.patch('wiki_sync.create_target_runs') as create_mock,
+        mock.patch('wiki_sync.sync_files', return_value=True) as sync_mock,
+    ):
+        assert daemon.sync_pushed_changes()
+
+    create_mock.assert_not_called()
+    assert sync_mock.call_args.args == (['docs.md'],)
+
+
+def test_default_branch_of_remote(clone, monkeypatch):
+    os.chdir(clone / 'clone')
+    monkeypatch.setenv('INPUT_DEFAULT-GIT-BRANCH', 'HEAD')
+    assert sync_daemon.SyncDaemon().branch == 'main'
+
+    # Without a remote HEAD, the branch has to be named
+    git('remote', 'set-head', 'origin', '--delete')
+    with pytest.raises(RuntimeError, match='INPUT_DEFAULT-GIT-BRANCH'):
+        sync_daemon.SyncDaemon()
+
+
+def test_failed_sync_is_retried(clone):
+    os.chdir(clone / 'clone')
+    daemon = sync_daemon.SyncDaemon()
+    push_file(clone, 'docs.md', 'Some docs')
+
+    with (
+        mock.patch('wiki_sync.create_target_runs'),
+        mock.patch('wiki_sync.sync_files', return_value=False),
+    ):
+        assert not daemon.sync_pushed_changes()
+
+    push_file(clone, 'other.md', 'Other docs')
+    with (
+        mock.patch('wiki_sync.create_target_runs'),
+        mock.patch('wiki_sync.sync_files', return_value=True) as sync_mock,
+    ):
+        assert daemon.sync_pushed_changes()
+
+    assert sync_mock.call_args.args == (['docs.md', 'other.md'],)
+
+
+def test_failed_sync_is_retried_without_push(clone):
+    os.chdir(clone / 'clone')
+    daemon = sync_daemon.SyncDaemon(retry_delay=0.01)
+    push_file(clone, 'docs.md', 'Some docs')
+
+    with (
+        mock.patch('wiki_sync.create_target_runs'),
+        mock.patch('wiki_sync.sync_files', side_effect=Exception('Wiki is down')),
+    ):
+        daemon.sync_or_retry_later()
+
+    deadline = time.monotonic() + 5
+    while not daemon.has_pending_push() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert daemon.has_pending_push()
+
+
+def test_sync_after_force_push(clone):
+    os.chdir(clone / 'clone')
+    daemon = sync_daemon.SyncDaemon()
+    push_file(clone, 'docs.md', 'Some docs')
+    with (
+        mock.patch('wiki_sync.create_target_runs'),
+        mock.patch('wiki_sync.sync_files', return_value=True),
+    ):
+        assert daemon.sync_pushed_changes()
+
+    # Rewrite the last commit
+    os.chdir(clone / 'pusher')
+    with open('docs.md', mode='w', encoding='utf-8') as docs_file:
+        print('Rewritten docs', file=docs_file)
+    git('commit', '--quiet', '--all', '--amend', '--no-edit')
+    git('push', '--quiet', '--force', 'origin', 'main')
+    os.chdir(clone / 'clone')
+
+    with (
+        mock.patch('wiki_sync.create_target_runs'),
+        mock.patch('wiki_sync.sync_files', return_value=True) as sync_mock,
+    ):
+        assert daemon.sync_pushed_changes()
+
+    assert sync_mock.call_args.args == (['docs.md'],)
+    assert daemon.last_synced_commit == git('rev-parse', 'HEAD')
+    with open('docs.md', encoding='utf-8') as docs_file:
+        assert docs_file.read() == 'Rewritten docs\n'
+
+
+def test_push_webhook(clone, monkeypatch):
+    os.chdir(clone / 'clone')
+    monkeypatch.setenv('INPUT_WEBHOOK-SECRET', 'secret')
+    daemon = sync_daemon.SyncDaemon()
+
+    sync_daemon.PushHandler.sync_daemon = daemon
+    server = http.server.ThreadingHTTPServer(('localhost', 0), sync_daemon.PushHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://localhost:{server.server_address[1]}'
+
+    def post(payload: dict, secret: bytes = b'secret') -> int:
+        body = json.dumps(payload).encode('utf-8')
+        signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        request = urllib.request.Request(
+            url,
+            data=body,
+            headers={
+                'X-GitHub-Event': 'push',
+                'X-Hub-Signature-256': f'sha256={signature}',
+            },
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    try:
+        assert post({'ref': 'refs/heads/main'}, secret=b'wrong') == 401
+        assert not daemon.has_pending_push()
+
+        # Only the default branch is synced
+        assert post({'ref': 'refs/heads/feature'}) == 200
+        assert not daemon.has_pending_push()
+
+        assert post({'ref': 'refs/heads/main'}) == 202
+        assert daemon.has_pending_push()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -4,17 +4,77 @@ This tool looks for modified doc files, transforms them into JIRA markdown and
 uploads them to Confluence
 """
 
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
 import logging
 import os
+import re
 import sys
+import time
 
 import atlassian
+import requests
 
+import attachments
 import content_converter
+import journal
+import link_graph
+import manifest
+import page_index
+import profiling
+import shared_assets
+
+
+# How many requests are sent at the same time by the stages that send them in bulk
+CONCURRENT_REQUESTS = 8
+
+# How orphaned pages can be handled, and how many are handled at the same time
+RECONCILE_MODES = ('dry-run', 'archive', 'delete')
+RECONCILE_BATCH_SIZE = 50
+# Removing more than this fraction of the pages of the repository at once is more
+# likely a broken checkout than a cleanup, so it requires the reconcile-force input
+RECONCILE_MAX_REMOVED_FRACTION = 0.5
+
+# Names of doc files, as they appear in the relative links of other doc files
+DOC_FILE_NAME_PATTERN = re.compile(r'[\w.-]+\.(?:md|rst)\b')
+
+
+@dataclasses.dataclass
+class KnownPage:
+    """A wiki page whose ID and current version are already known
+
+    Allows updating the page directly, without looking it up first"""
+
+    page_id: str
+    version: int
 
 
 def get_files_to_sync(changed_files: str) -> list[str]:
-    return [f for f in changed_files.split('|') if should_sync_file(f)]
+    files = [f for f in changed_files.split('|') if should_sync_file(f)]
+
+    shard_index = int(os.environ.get('INPUT_SHARD-INDEX') or 0)
+    shard_count = int(os.environ.get('INPUT_SHARD-COUNT') or 1)
+    if shard_count > 1:
+        files = [f for f in files if is_in_shard(f, shard_index, shard_count)]
+        logging.info(
+            'Shard %s/%s: syncing %s files', shard_index, shard_count, len(files)
+        )
+
+    return files
+
+
+def is_in_shard(file_name: str, shard_index: int, shard_count: int) -> bool:
+    """Files are spread over shards depending on a hash of their name
+
+    The hash is stable between runs and machines, so parallel jobs that get the same
+    list of files agree on which job syncs each file."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'Invalid shard {shard_index} for {shard_count} shards')
+
+    file_hash = hashlib.sha256(file_name.encode('utf-8')).digest()
+    return int.from_bytes(file_hash[:8], 'big') % shard_count == shard_index
 
 
 def should_sync_file(file_name: str) -> bool:
@@ -44,89 +104,618 @@ def should_sync_file(file_name: str) -> bool:
     return True
 
 
-def sync_files(files: list[str]) -> bool:
+@dataclasses.dataclass
+class SyncTarget:
+    """A Confluence space and root page that files are synced under"""
+
+    space_name: str
+    root_page_title: str
+
+
+@dataclasses.dataclass
+class _TargetRun:
+    """What is needed to sync files to a target during a run"""
+
+    target: SyncTarget
+    wiki_client: atlassian.Confluence
+    root_page_id: int
+    converter: content_converter.ContentConverter
+    # Page ID of each folder of the synced files, by folder path
+    folder_page_ids: dict[str, str] = dataclasses.field(default_factory=dict)
+    # All the pages under the root page, by title, if they were listed
+    known_pages: dict[str, page_index.IndexedPage] = dataclasses.field(
+        default_factory=dict
+    )
+    # Whether known_pages is complete, so a page that isn't in it doesn't exist
+    pages_listed: bool = False
+
+
+def get_sync_targets() -> list[SyncTarget]:
+    """The main target comes from the space-name and root-page-title inputs. Extra
+    targets are one per line, in the form `space-name:root page title`, each in a
+    different space"""
+    targets = [
+        SyncTarget(os.environ['INPUT_SPACE-NAME'], os.environ['INPUT_ROOT-PAGE-TITLE'])
+    ]
+
+    for line in os.environ.get('INPUT_ADDITIONAL-TARGETS', '').splitlines():
+        if not line.strip():
+            continue  # Ignore empty lines
+
+        space_name, separator, root_page_title = line.strip().partition(':')
+        if not separator or not space_name or not root_page_title:
+            raise ValueError(
+                f'Invalid target {line!r}, expected `space-name:root page title`'
+            )
+        targets.append(SyncTarget(space_name.strip(), root_page_title.strip()))
+
+    # Page titles, and the state kept about them, are only unique within a space
+    space_names = [target.space_name for target in targets]
+    duplicate_space_names = sorted(
+        {name for name in space_names if space_names.count(name) > 1}
+    )
+    if duplicate_space_names:
+        raise ValueError(
+            f'Several targets in space(s) {", ".join(duplicate_space_names)}: each'
+            ' target must be in a different space'
+        )
+
+    return targets
+
+
+@dataclasses.dataclass
+class _SyncRun:
+    """State shared by all the files synced during a run"""
+
+    repo_name: str
+    target_runs: list[_TargetRun]
+    # Runs the uploads to the different targets concurrently
+    executor: concurrent.futures.Executor
+    graph: link_graph.LinkGraph
+    sync_manifest: manifest.SyncManifest
+    sync_journal: journal.SyncJournal
+    # JIRA markdown of files, by hash of their contents, kept between runs
+    conversion_cache: dict[str, str] | None = None
+    # Files synced as source code because they couldn't be converted, with the reason
+    degraded_files: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+def _get_url_root_for_file() -> str:
+    github_repo = os.environ['GITHUB_REPOSITORY']
+    default_git_branch = os.environ['INPUT_DEFAULT-GIT-BRANCH']
+    return f'https://github.com/{github_repo}/blob/{default_git_branch}/'
+
+
+def create_target_runs() -> list[_TargetRun] | None:
+    """Sets up the targets to sync files to
+
+    Returns None if a root page doesn't exist"""
+    github_repo = os.environ['GITHUB_REPOSITORY']  # eg. 'octocat/Hello-World'
+    repo_name = github_repo.split('/')[1]
+    url_root_for_file = _get_url_root_for_file()
+
+    target_runs: list[_TargetRun] = []
+    for target in get_sync_targets():
+        wiki_client = _create_wiki_client()
+
+        with profiling.stage('setup'):
+            root_page_id = _get_root_page_id(wiki_client, target)
+        if not root_page_id:
+            return None
+
+        logging.debug(
+            'The base root ID for space %s is %s', target.space_name, root_page_id
+        )
+
+        converter = content_converter.ContentConverter(
+            wiki_client, url_root_for_file, repo_name, target.space_name
+        )
+        target_runs.append(_TargetRun(target, wiki_client, root_page_id, converter))
+
+    return target_runs
+
+
+def sync_files(
+    files: list[str],
+    known_pages: dict[tuple[str, str], KnownPage] | None = None,
+    target_runs: list[_TargetRun] | None = None,
+    conversion_cache: dict[str, str] | None = None,
+) -> bool:
     """
     param files: List of file paths relative to the repository root
+    param known_pages: Pages whose ID and version are already known, by space name and
+        file path. The pages written by the sync are added to it, with their new
+        version, so it can be passed to the next sync.
+    param target_runs: Targets set up by a previous run, see create_target_runs
+    param conversion_cache: JIRA markdown of the files converted by previous runs, by
+        hash of their contents
     returns: True if the sync was successful
 
     The script runs at the root of the repo as well, so the paths are also relative to
-    the current script."""
+    the current script.
+
+    Each file is converted once, then uploaded to all the targets concurrently."""
+    start_time = time.monotonic()
+    time_budget = float(os.environ.get('INPUT_TIME-BUDGET') or 0)
     success = True
+    if known_pages is None:
+        known_pages = {}
 
-    wiki_client = _create_wiki_client()
+    github_repo = os.environ['GITHUB_REPOSITORY']  # eg. 'octocat/Hello-World'
+    repo_name = github_repo.split('/')[1]
 
-    root_page_id = _get_root_page_id(wiki_client)
-    if not root_page_id:
+    if target_runs is None:
+        target_runs = create_target_runs()
+    if not target_runs:
         return False
 
-    logging.debug('The base root ID is %s', root_page_id)
+    graph = link_graph.LinkGraph(os.environ.get('INPUT_LINK-GRAPH-FILE', ''))
+    graph.load()
 
-    github_repo = os.environ['GITHUB_REPOSITORY']  # eg. 'octocat/Hello-World'
-    repo_name = github_repo.split('/')[1]
-
-    default_git_branch = os.environ['INPUT_DEFAULT-GIT-BRANCH']
-    url_root_for_file = f'https://github.com/{github_repo}/blob/{default_git_branch}/'
+    sync_manifest = manifest.SyncManifest(os.environ.get('INPUT_MANIFEST-FILE', ''))
+    sync_manifest.load()
 
-    converter = content_converter.ContentConverter(
-        wiki_client, url_root_for_file, repo_name
+    sync_journal = journal.SyncJournal(
+        os.environ.get('INPUT_JOURNAL-FILE', ''), os.environ.get('GITHUB_SHA', '')
     )
+    sync_journal.load()
 
-    for file_path in files:
-        read_only_warning = (
-            '{info:title=Imported content|icon=true}'
-            f'This content has been imported from the {repo_name} repository.'
-            '\nYou can find (and modify) the original at'
-            f' {url_root_for_file + file_path}.{{info}}\n'
-            '{warning:title=Do not update this page directly|icon=true}'
-            'Your modifications would be lost the next time the source file'
-            ' is updated.{warning}\n'
-        )
-
-        if not os.path.exists(file_path):
-            # See #9
-            logging.warning(
-                'File %s not found. Deleting a wiki page is not currently'
-                ' supported, so you will have to delete it manually',
-                file_path,
+    with concurrent.futures.ThreadPoolExecutor(len(target_runs)) as executor:
+        sync_run = _SyncRun(
+            repo_name,
+            target_runs,
+            executor,
+            graph,
+            sync_manifest,
+            sync_journal,
+            conversion_cache,
+        )
+
+        if sync_manifest.manifest_path:
+            # Listing all the pages is cheap compared to looking them up one by one,
+            # and tells us which parts of the manifest are still valid
+            for target_run, pages in zip(
+                target_runs,
+                executor.map(_list_pages_under_root, target_runs),
+            ):
+                target_run.pages_listed = pages is not None
+                target_run.known_pages = pages or {}
+                target_run.converter.known_pages = target_run.known_pages
+                target_run.converter.pages_listed = target_run.pages_listed
+                if pages is None:
+                    # Pages are looked up one by one instead, and the manifest can't
+                    # be trusted without knowing which pages still exist
+                    sync_manifest.forget(target_run.target.space_name)
+                    continue
+                sync_manifest.validate(
+                    target_run.target.space_name,
+                    {
+                        title.removeprefix(f'{repo_name}/'): page
+                        for title, page in pages.items()
+                    },
+                )
+        else:
+            # The target runs may come from a previous run, whose pages are outdated
+            for target_run in target_runs:
+                target_run.pages_listed = False
+                target_run.known_pages = {}
+                target_run.converter.known_pages = {}
+                target_run.converter.pages_listed = False
+
+        # Create all the missing folder pages upfront, rather than one at a time for
+        # each file
+        existing_files = [f for f in files if os.path.exists(f)]
+        for target_run, folder_page_ids in zip(
+            target_runs,
+            executor.map(
+                lambda target_run: create_folder_pages(
+                    target_run.wiki_client,
+                    target_run.target.space_name,
+                    target_run.root_page_id,
+                    repo_name,
+                    existing_files,
+                    target_run.known_pages,
+                    target_run.pages_listed,
+                ),
+                target_runs,
+            ),
+        ):
+            target_run.folder_page_ids = folder_page_ids
+
+        if os.environ.get('INPUT_SHARED-ASSETS', 'false').lower() == 'true':
+            for target_run, assets_page in zip(
+                target_runs, executor.map(_get_shared_assets_page, target_runs)
+            ):
+                target_run.converter.shared_assets = assets_page
+
+        # When files of the run link to each other, make sure the pages they link to
+        # exist first, so the links point to them without being looked up. They are
+        # synced first, so their pages get their real contents before the time budget
+        # runs out.
+        linked_files = find_linked_files(existing_files)
+        if time_budget and time.monotonic() - start_time > time_budget:
+            linked_files = []
+        if linked_files:
+            linked_file_set = set(linked_files)
+            files = linked_files + [f for f in files if f not in linked_file_set]
+            for target_run, linked_pages in zip(
+                target_runs,
+                executor.map(
+                    lambda target_run: create_linked_pages(
+                        target_run.wiki_client,
+                        target_run.target.space_name,
+                        target_run.root_page_id,
+                        repo_name,
+                        linked_files,
+                        target_run.known_pages,
+                        target_run.folder_page_ids,
+                        target_run.pages_listed,
+                    ),
+                    target_runs,
+                ),
+            ):
+                target_run.known_pages = {**target_run.known_pages, **linked_pages}
+                target_run.converter.known_pages = target_run.known_pages
+
+        out_of_time = False
+        synced_files: set[str] = set()
+        for file_index, file_path in enumerate(files):
+            if time_budget and time.monotonic() - start_time > time_budget:
+                logging.warning(
+                    'Time budget of %ss exceeded, stopping after %s of %s files.'
+                    ' Run the sync again for the same commit to resume it.',
+                    time_budget,
+                    file_index,
+                    len(files),
+                )
+                out_of_time = True
+                success = False
+                break
+
+            if not os.path.exists(file_path):
+                # See #9
+                logging.warning(
+                    'File %s not found. Deleting a wiki page is not currently'
+                    ' supported, so you will have to delete it manually',
+                    file_path,
+                )
+                continue
+
+            if _sync_file(sync_run, file_path, known_pages):
+                synced_files.add(file_path)
+            else:
+                success = False
+
+        # Pages that were synced before this run still link to GitHub for the files
+        # that only got a page now. Re-render them so they link to the new pages.
+        # With shards, the graph only has the links of the files of this shard, so
+        # pages of other shards are left as they are.
+        if graph.graph_path and not out_of_time:
+            backlinking_files = [
+                f
+                for f in graph.sources_with_unresolved_links_to(synced_files)
+                if f not in synced_files and os.path.exists(f) and should_sync_file(f)
+            ]
+            if backlinking_files:
+                logging.info('Updating links in files: %s', backlinking_files)
+            for file_path in backlinking_files:
+                if not _sync_file(sync_run, file_path, known_pages, resumable=False):
+                    success = False
+
+        graph.save()
+        sync_manifest.save()
+        _report_degraded_files(sync_run.degraded_files)
+
+    return success
+
+
+def _list_pages_under_root(
+    target_run: _TargetRun,
+) -> dict[str, page_index.IndexedPage] | None:
+    """Returns None if the pages couldn't be listed"""
+    try:
+        with profiling.stage('setup'):
+            return page_index.list_descendant_pages(
+                target_run.wiki_client, target_run.root_page_id
             )
-            continue
+    except Exception:
+        logging.exception(
+            'Error listing the pages of %s, looking them up one by one instead:',
+            target_run.target.space_name,
+        )
+        return None
+
+
+def _get_shared_assets_page(
+    target_run: _TargetRun,
+) -> shared_assets.SharedAssetsPage | None:
+    if target_run.converter.shared_assets:
+        return target_run.converter.shared_assets  # Kept from a previous run
 
+    with profiling.stage('setup'):
+        return shared_assets.get_shared_assets_page(
+            target_run.wiki_client,
+            target_run.target.space_name,
+            target_run.root_page_id,
+            target_run.converter.repo_name,
+            target_run.known_pages,
+            target_run.pages_listed,
+        )
+
+
+def _sync_file(
+    sync_run: _SyncRun,
+    file_path: str,
+    known_pages: dict[tuple[str, str], KnownPage],
+    resumable: bool = True,
+) -> bool:
+    """Converts a single file and uploads it to all the targets
+
+    If resumable, the completed steps are recorded in the journal, and the ones that
+    were completed by a previous run for the same commit are skipped.
+
+    Returns True if the sync was successful"""
+    sync_journal = sync_run.sync_journal
+    conversion_cache = sync_run.conversion_cache
+    converted = resumable and sync_journal.get(journal.CONVERTED, file_path)
+    if converted:
+        jira_contents = converted['contents']
+    else:
         try:
-            formatted_content = converter.convert_file_contents(file_path)
+            with profiling.stage('conversion'):
+                jira_contents = _convert_file(file_path, conversion_cache)
+        except content_converter.ConversionLimitExceeded as e:
+            logging.warning('%s, syncing its source instead', e)
+            sync_run.degraded_files[file_path] = str(e)
+            jira_contents = _render_source(file_path)
         except Exception:
             logging.exception('Error converting file %s:', file_path)
-            success = False
-            continue
+            return False
+        if resumable:
+            sync_journal.record(journal.CONVERTED, file_path, contents=jira_contents)
 
-        if os.environ.get('INPUT_ADD-WARNING-BANNER', 'true').lower() == 'true':
-            content = read_only_warning + formatted_content
-        else:
-            content = formatted_content
+    results = sync_run.executor.map(
+        lambda target_run: _sync_file_to_target(
+            sync_run,
+            target_run,
+            file_path,
+            jira_contents,
+            known_pages,
+            resumable,
+        ),
+        sync_run.target_runs,
+    )
+
+    success = True
+    # A link only counts as resolved if it was resolved for every target
+    resolved_links: dict[str, bool] = {}
+    for target_success, target_resolved_links in results:
+        success = success and target_success
+        for target_path, resolved in target_resolved_links.items():
+            previously_resolved = resolved_links.get(target_path, True)
+            resolved_links[target_path] = previously_resolved and resolved
+
+    if success:
+        sync_run.graph.record(file_path, resolved_links)
 
+    return success
+
+
+def _render_source(file_path: str, reason: str = 'could not be converted') -> str:
+    max_file_size = int(os.environ.get('INPUT_MAX-FILE-SIZE') or 0) * 1024
+    return content_converter.render_source(
+        file_path, _get_url_root_for_file() + file_path, reason, max_file_size
+    )
+
+
+def _convert_file(file_path: str, conversion_cache: dict[str, str] | None) -> str:
+    timeout = float(os.environ.get('INPUT_CONVERSION-TIMEOUT') or 0)
+    max_file_size = int(os.environ.get('INPUT_MAX-FILE-SIZE') or 0) * 1024
+    fast_markdown = os.environ.get('INPUT_FAST-MARKDOWN', 'true').lower() == 'true'
+    if conversion_cache is None:
+        return content_converter.convert_to_jira(
+            file_path, timeout, max_file_size, fast_markdown
+        )
+
+    # The conversion only depends on the contents of the file and its format
+    _, file_ext = os.path.splitext(file_path)
+    cache_key = f'{manifest.file_hash(file_path)}{file_ext}'
+    if cache_key not in conversion_cache:
+        conversion_cache[cache_key] = content_converter.convert_to_jira(
+            file_path, timeout, max_file_size, fast_markdown
+        )
+    else:
+        logging.debug('Using the cached conversion of %s', file_path)
+    return conversion_cache[cache_key]
+
+
+def _report_degraded_files(degraded_files: dict[str, str]) -> None:
+    """Lists the files that couldn't be converted in the log and the job summary"""
+    if not degraded_files:
+        return
+
+    logging.warning(
+        'These files were synced as source code, because they could not be'
+        ' converted: %s',
+        degraded_files,
+    )
+
+    summary_path = os.environ.get('GITHUB_STEP_SUMMARY')
+    if not summary_path:
+        return
+    with open(summary_path, mode='a', encoding='utf-8') as summary_file:
+        print('### Files synced as source code\n', file=summary_file)
+        for file_path, reason in sorted(degraded_files.items()):
+            print(f'* `{file_path}`: {reason}', file=summary_file)
+        print(file=summary_file)
+
+
+def _sync_file_to_target(
+    sync_run: _SyncRun,
+    target_run: _TargetRun,
+    file_path: str,
+    jira_contents: str,
+    known_pages: dict[tuple[str, str], KnownPage],
+    resumable: bool = True,
+) -> tuple[bool, dict[str, bool]]:
+    """Uploads the JIRA markdown of a file to a single target
+
+    The written page is added to known_pages, by space name and file path.
+
+    Returns whether the sync was successful, and for each relative link of the file,
+    whether it points to a Confluence page"""
+    wiki_client = target_run.wiki_client
+    converter = target_run.converter
+    sync_manifest = sync_run.sync_manifest
+    sync_journal = sync_run.sync_journal
+    space_name = target_run.target.space_name
+    url_root_for_file = converter.gh_root
+
+    if resumable and sync_journal.is_done(
+        journal.ATTACHMENTS_UPLOADED, file_path, space_name
+    ):
+        logging.info('%s was already synced to %s', file_path, space_name)
+        written = sync_journal.get(journal.PAGE_WRITTEN, file_path, space_name)
+        return True, written['resolved_links']
+
+    written = resumable and sync_journal.get(
+        journal.PAGE_WRITTEN, file_path, space_name
+    )
+    if written:
+        # The page is up to date, only its new attachments are missing
+        logging.info('Page of %s was already written to %s', file_path, space_name)
+        page_id = written['page_id']
+        resolved_links = written['resolved_links']
+        attachment_paths = written['attachments']
+        manifest_entry = None
+    else:
+        known_page_key = (space_name, file_path)
         try:
-            page_id = create_or_update_pages_for_file(
-                wiki_client, root_page_id, repo_name, file_path, content
+            page, manifest_entry = _write_page(
+                sync_run,
+                target_run,
+                file_path,
+                jira_contents,
+                known_pages.get(known_page_key),
             )
         except Exception:
             logging.exception('Error uploading file %s:', file_path)
-            success = False
-            continue
+            # e.g. the page was deleted, it needs to be looked up next time
+            known_pages.pop(known_page_key, None)
+            return False, {}
+        known_pages[known_page_key] = page
+        page_id = page.page_id
 
-        # Image attachments are decided when parsing the JIRA markdown contents of the
-        # file. If the file is new in the latest commit, its wiki page hadn't been
-        # created at that stage. So we go back and attach these images now.
-        for attachment_path in converter.files_to_attach_to_last_page:
-            try:
-                logging.info('Attaching file %s to page %s', attachment_path, page_id)
-                wiki_client.attach_file(filename=attachment_path, page_id=page_id)
-            except Exception:
-                logging.exception(
-                    'Error attaching %s to %s:', attachment_path, file_path
-                )
-                success = False
-                continue
+        resolved_links = {
+            link.target_path: not link.wiki_link.startswith(url_root_for_file)
+            for link in converter.links_of_last_page
+            if link.link_type == content_converter.RelativeLinkType.GENERIC
+        }
+        attachment_paths = list(converter.files_to_attach_to_last_page)
+        if resumable:
+            sync_journal.record(
+                journal.PAGE_WRITTEN,
+                file_path,
+                space_name,
+                page_id=page_id,
+                resolved_links=resolved_links,
+                attachments=attachment_paths,
+            )
+
+    # Image attachments are decided when parsing the JIRA markdown contents of the
+    # file. If the file is new in the latest commit, its wiki page hadn't been
+    # created at that stage. So we go back and attach these images now.
+    with profiling.stage('upload'):
+        failed_paths = attachments.upload_attachments(
+            wiki_client, page_id, attachment_paths
+        )
+    success = not failed_paths
+    if not success:
+        return False, resolved_links
+
+    if resumable:
+        sync_journal.record(journal.ATTACHMENTS_UPLOADED, file_path, space_name)
+    if manifest_entry and sync_manifest.manifest_path:
+        sync_manifest.set(space_name, file_path, manifest_entry)
+
+    return True, resolved_links
 
-    return success
+
+def _write_page(
+    sync_run: _SyncRun,
+    target_run: _TargetRun,
+    file_path: str,
+    jira_contents: str,
+    known_page: KnownPage | None,
+) -> tuple[KnownPage, manifest.ManifestEntry]:
+    """Fixes the links of the JIRA markdown of a file, and writes it to its page
+
+    Returns the page, and what the manifest should know about it once its attachments
+    are uploaded"""
+    converter = target_run.converter
+    repo_name = sync_run.repo_name
+    space_name = target_run.target.space_name
+    url_root_for_file = converter.gh_root
+
+    # What we know about the page, from the manifest or the list of pages
+    manifest_entry = sync_run.sync_manifest.get(space_name, file_path)
+    indexed_page = target_run.known_pages.get(f'{repo_name}/{file_path}')
+    if not known_page and manifest_entry:
+        known_page = KnownPage(manifest_entry.page_id, manifest_entry.version)
+    elif not known_page and indexed_page:
+        known_page = KnownPage(indexed_page.page_id, indexed_page.version)
+
+    read_only_warning = (
+        '{info:title=Imported content|icon=true}'
+        f'This content has been imported from the {repo_name} repository.'
+        '\nYou can find (and modify) the original at'
+        f' {url_root_for_file + file_path}.{{info}}\n'
+        '{warning:title=Do not update this page directly|icon=true}'
+        'Your modifications would be lost the next time the source file'
+        ' is updated.{warning}\n'
+    )
+
+    converter.attachment_hashes = (
+        dict(manifest_entry.attachments) if manifest_entry else None
+    )
+    with profiling.stage('link rewriting'):
+        formatted_content = converter.fix_relative_links(file_path, jira_contents)
+
+    if os.environ.get('INPUT_ADD-WARNING-BANNER', 'true').lower() == 'true':
+        content = read_only_warning + formatted_content
+    else:
+        content = formatted_content
+
+    body_hash = manifest.content_hash(content)
+    if manifest_entry and manifest_entry.body_hash == body_hash:
+        logging.info('Page of %s is up to date', file_path)
+        page = known_page
+    else:
+        with profiling.stage('upload'):
+            page = create_or_update_pages_for_file(
+                target_run.wiki_client,
+                space_name,
+                target_run.root_page_id,
+                repo_name,
+                file_path,
+                content,
+                known_page,
+                target_run.folder_page_ids,
+                target_run.pages_listed,
+            )
+
+    return page, manifest.ManifestEntry(
+        page_id=page.page_id,
+        version=page.version,
+        body_hash=body_hash,
+        attachments={
+            os.path.basename(link.target_path): manifest.file_hash(link.target_path)
+            for link in converter.links_of_last_page
+            if link.link_type == content_converter.RelativeLinkType.IMAGE
+            # Shared assets aren't attached to the page
+            and not converter.shared_assets
+        },
+    )
 
 
 def _create_wiki_client() -> None:
@@ -138,35 +727,46 @@ def _create_wiki_client() -> None:
     )
 
 
-def _get_root_page_id(wiki_client) -> None:
-    space_name = os.environ['INPUT_SPACE-NAME']
-    root_page_title = os.environ['INPUT_ROOT-PAGE-TITLE']
-    root_page_id = wiki_client.get_page_id(space_name, root_page_title)
+def _get_root_page_id(wiki_client, target: SyncTarget) -> None:
+    root_page_id = wiki_client.get_page_id(target.space_name, target.root_page_title)
 
     if not root_page_id:
         logging.error(
-            'Could not find root page %s in space %s', root_page_title, space_name
+            'Could not find root page %s in space %s',
+            target.root_page_title,
+            target.space_name,
         )
     return root_page_id
 
 
 def create_or_update_pages_for_file(
     wiki_client: atlassian.Confluence,
+    space_name: str,
     root_page_id: int,
     repo_name: str,
     file_name: str,
     content: str,
-) -> str:
-    """Returns the ID of the created/updated page"""
+    known_page: KnownPage | None = None,
+    folder_page_ids: dict[str, str] | None = None,
+    pages_listed: bool = False,
+) -> KnownPage:
+    """Returns the created/updated page, with its new version
+
+    If the page and its version are already known, it is updated directly. If all the
+    pages were listed and it isn't known, it is created directly. Otherwise, it is
+    looked up by title first.
+
+    folder_page_ids contains the folder pages created by create_folder_pages"""
     # The git docs live in a tree under the root page, with the same
     # tree structure as in the git repo.
     # We need to navigate the tree to find where the page lives,
     # creating intermediate pages if they don't exist.
-    space_name = os.environ['INPUT_SPACE-NAME']
     current_root_id = root_page_id
     file_path, _ = os.path.split(file_name)
 
-    if file_path:
+    if file_path in (folder_page_ids or {}):
+        current_root_id = folder_page_ids[file_path]
+    elif file_path:
         page_title = repo_name
         for current_folder in file_path.split(os.sep):
             page_title += f'/{current_folder}'
@@ -180,38 +780,489 @@ def create_or_update_pages_for_file(
                     page_title,
                     current_root_id,
                 )
-                response = wiki_client.create_page(
-                    space=space_name,
-                    title=page_title,
-                    body='{children:sort=title|excerpt=none|all=true}',
-                    parent_id=current_root_id,
-                    representation='wiki',
+                current_root_id = create_folder_page(
+                    wiki_client, space_name, page_title, current_root_id
                 )
-                current_root_id = response['id']
             logging.debug('Current root ID is %s', current_root_id)
 
     title = f'{repo_name}/{file_name}'
     logging.info('Creating or updating page %s under root %s', title, current_root_id)
     # TODO Consider making the page read-only
-    response = wiki_client.update_or_create(
-        parent_id=current_root_id, title=title, body=content, representation='wiki'
-    )
+    if known_page:
+        response = update_page_with_version(
+            wiki_client, known_page, current_root_id, title, content
+        )
+    elif pages_listed:
+        try:
+            response = wiki_client.create_page(
+                space=space_name,
+                title=title,
+                body=content,
+                parent_id=current_root_id,
+                representation='wiki',
+            )
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:
+                raise
+            # It was created since the pages were listed, e.g. by another shard
+            response = wiki_client.update_or_create(
+                parent_id=current_root_id,
+                title=title,
+                body=content,
+                representation='wiki',
+            )
+    else:
+        response = wiki_client.update_or_create(
+            parent_id=current_root_id, title=title, body=content, representation='wiki'
+        )
+    return KnownPage(response['id'], response.get('version', {}).get('number', 0))
+
+
+def create_folder_pages(
+    wiki_client: atlassian.Confluence,
+    space_name: str,
+    root_page_id: int,
+    repo_name: str,
+    files: list[str],
+    known_pages: dict[str, page_index.IndexedPage] | None = None,
+    pages_listed: bool = False,
+) -> dict[str, str]:
+    """Makes sure each folder of the files has a page. Returns their IDs by folder path
+
+    Folders are handled breadth-first: all the folders at the same depth are looked up
+    (and created if needed) concurrently, since they only depend on their parents.
+    If a folder page can't be created, its subfolders are skipped.
+
+    known_pages are the pages that exist, by title, if they were listed beforehand.
+    They don't need to be looked up. If pages_listed, all the pages were listed, so
+    the folder pages that aren't known are created without being looked up."""
+    folders_by_depth: dict[int, set[str]] = {}
+    for file_name in files:
+        folder, _ = os.path.split(file_name)
+        while folder:
+            folders_by_depth.setdefault(folder.count(os.sep), set()).add(folder)
+            folder, _ = os.path.split(folder)
+
+    folder_page_ids: dict[str, str] = {}
+
+    def get_or_create_folder_page(folder: str) -> str | None:
+        parent_folder, _ = os.path.split(folder)
+        parent_id = folder_page_ids[parent_folder] if parent_folder else root_page_id
+        page_title = f'{repo_name}/{folder}'.replace(os.sep, '/')
+        if page_title in (known_pages or {}):
+            return known_pages[page_title].page_id
+
+        try:
+            with profiling.stage('upload'):
+                page_id = (
+                    None
+                    if pages_listed
+                    else wiki_client.get_page_id(space_name, page_title)
+                )
+                if page_id:
+                    logging.debug('Page %s exists with id %s', page_title, page_id)
+                    return page_id
+
+                logging.info(
+                    'Creating intermediate page %s under root %s',
+                    page_title,
+                    parent_id,
+                )
+                return create_folder_page(
+                    wiki_client, space_name, page_title, parent_id
+                )
+        except Exception:
+            logging.exception('Error creating intermediate page %s:', page_title)
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(CONCURRENT_REQUESTS) as executor:
+        for depth in sorted(folders_by_depth):
+            folders = sorted(
+                folder
+                for folder in folders_by_depth[depth]
+                # Skip the folders whose parent couldn't be created
+                if os.path.dirname(folder) in folder_page_ids
+                or not os.path.dirname(folder)
+            )
+            for folder, page_id in zip(
+                folders, executor.map(get_or_create_folder_page, folders)
+            ):
+                if page_id:
+                    folder_page_ids[folder] = page_id
+
+    return folder_page_ids
+
+
+def create_folder_page(
+    wiki_client: atlassian.Confluence, space_name: str, title: str, parent_id: int
+) -> str:
+    """Creates a page listing the children of a folder. Returns its ID
+
+    Other jobs (e.g. other shards of the same sync) may create the same folder page at
+    the same time. If the page was created since we last checked, use it."""
+    try:
+        response = wiki_client.create_page(
+            space=space_name,
+            title=title,
+            body='{children:sort=title|excerpt=none|all=true}',
+            parent_id=parent_id,
+            representation='wiki',
+        )
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 400:
+            raise
+
+        # Confluence answers with a 400 when a page with that title already exists
+        page_id = wiki_client.get_page_id(space_name, title)
+        if not page_id:
+            raise
+        logging.info('Page %s was created concurrently with id %s', title, page_id)
+        return page_id
+
     return response['id']
 
 
+def find_linked_files(files: list[str]) -> list[str]:
+    """Returns the files that are probably linked to by other files of the list
+
+    Looks for their names in the source of the other files, which is much cheaper than
+    converting them. Files that are only mentioned are included too."""
+    files_by_name: dict[str, list[str]] = {}
+    for file_path in files:
+        files_by_name.setdefault(os.path.basename(file_path), []).append(file_path)
+
+    linked_files: set[str] = set()
+    for file_path in files:
+        with open(file_path, encoding='utf-8', errors='replace') as doc_file:
+            mentioned_names = set(DOC_FILE_NAME_PATTERN.findall(doc_file.read()))
+        for name in mentioned_names:
+            linked_files.update(
+                linked_file
+                for linked_file in files_by_name.get(name, [])
+                if linked_file != file_path
+            )
+
+    return sorted(linked_files)
+
+
+def create_linked_pages(
+    wiki_client: atlassian.Confluence,
+    space_name: str,
+    root_page_id: int,
+    repo_name: str,
+    files: list[str],
+    known_pages: dict[str, page_index.IndexedPage],
+    folder_page_ids: dict[str, str],
+    pages_listed: bool = False,
+) -> dict[str, page_index.IndexedPage]:
+    """Makes sure each file has a page, before any of them is converted. Returns the
+    pages that weren't known, by title
+
+    Pages that don't exist are created with the source of their file, and written for
+    real when their file is synced. If the file isn't synced, e.g. because the job is
+    cancelled, the page still shows something useful. If pages_listed, the pages that
+    aren't known don't exist, so they are created without being looked up."""
+
+    def get_or_create_page(file_path: str) -> page_index.IndexedPage | None:
+        folder, _ = os.path.split(file_path)
+        if folder and folder not in folder_page_ids:
+            return None  # Its folder page couldn't be created
+        parent_id = folder_page_ids[folder] if folder else root_page_id
+        title = f'{repo_name}/{file_path}'
+
+        try:
+            with profiling.stage('upload'):
+                page = (
+                    None
+                    if pages_listed
+                    else wiki_client.get_page_by_title(
+                        space_name, title, expand='version'
+                    )
+                )
+                if not page:
+                    logging.info('Creating page %s ahead of its contents', title)
+                    try:
+                        page = wiki_client.create_page(
+                            space=space_name,
+                            title=title,
+                            body=_render_source(file_path, 'was not synced yet'),
+                            parent_id=parent_id,
+                            representation='wiki',
+                        )
+                    except requests.HTTPError as e:
+                        if e.response is None or e.response.status_code != 400:
+                            raise
+                        # It was created concurrently, e.g. by another shard
+                        page = wiki_client.get_page_by_title(
+                            space_name, title, expand='version'
+                        )
+        except Exception:
+            logging.exception('Error creating page %s:', title)
+            return None
+
+        if not page:
+            return None
+        return page_index.IndexedPage(
+            page_id=page['id'],
+            title=title,
+            version=page['version']['number'],
+            webui=page['_links']['webui'],
+        )
+
+    unknown_files = [f for f in files if f'{repo_name}/{f}' not in known_pages]
+    with concurrent.futures.ThreadPoolExecutor(CONCURRENT_REQUESTS) as executor:
+        pages = executor.map(get_or_create_page, unknown_files)
+        return {page.title: page for page in pages if page}
+
+
+def update_page_with_version(
+    wiki_client: atlassian.Confluence,
+    page: KnownPage,
+    parent_id: int,
+    title: str,
+    content: str,
+) -> dict:
+    """Writes the next version of a page whose current version is known
+
+    Unlike update_or_create, this doesn't look up the page or read its contents first.
+    If someone else updated the page in the meantime, Confluence answers with a 409
+    conflict: in that case, fetch the current version and try again, once."""
+    try:
+        return _put_page(wiki_client, page, parent_id, title, content)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 409:
+            raise
+
+    logging.info('Version conflict on page %s, fetching its current version', title)
+    current_page = wiki_client.get_page_by_id(page.page_id, expand='version')
+    page.version = current_page['version']['number']
+    return _put_page(wiki_client, page, parent_id, title, content)
+
+
+def _put_page(
+    wiki_client: atlassian.Confluence,
+    page: KnownPage,
+    parent_id: int,
+    title: str,
+    content: str,
+) -> dict:
+    response = wiki_client.put(
+        f'rest/api/content/{page.page_id}',
+        data={
+            'id': page.page_id,
+            'type': 'page',
+            'title': title,
+            'version': {'number': page.version + 1, 'minorEdit': False},
+            'ancestors': [{'type': 'page', 'id': parent_id}],
+            'body': {'wiki': {'value': content, 'representation': 'wiki'}},
+        },
+        params={'status': 'current'},
+    )
+    # Keep track of the new version, in case the page is updated again
+    page.version = response['version']['number']
+    return response
+
+
+def reconcile_pages(mode: str) -> bool:
+    """Removes the pages of files that are no longer in the repository
+
+    param mode: 'dry-run' to only report the orphaned pages, 'archive' or 'delete'
+    returns: True if all orphaned pages were handled
+
+    Orphaned pages are the pages under a root page, named after the repository, that
+    match neither a doc file of the repository nor a folder containing one. They are
+    found by comparing a listing of the whole subtree to the files on disk."""
+    if mode not in RECONCILE_MODES:
+        raise ValueError(f'Invalid reconcile mode {mode!r}')
+
+    if int(os.environ.get('INPUT_SHARD-INDEX') or 0) != 0:
+        logging.info('Pages are only reconciled by the first shard')
+        return True
+
+    github_repo = os.environ['GITHUB_REPOSITORY']  # eg. 'octocat/Hello-World'
+    repo_name = github_repo.split('/')[1]
+
+    doc_files = list_doc_files()
+    if not doc_files:
+        # e.g. the wrong working directory, or a sparse checkout
+        logging.error('No doc files found in %s, not reconciling', os.getcwd())
+        return False
+    force = os.environ.get('INPUT_RECONCILE-FORCE', 'false').lower() == 'true'
+    prune_assets = os.environ.get('INPUT_SHARED-ASSETS', 'false').lower() == 'true'
+    if prune_assets and int(os.environ.get('INPUT_SHARD-COUNT') or 1) > 1:
+        # Other shards may have uploaded images that the pages using them don't
+        # refer to yet
+        logging.info('Shared assets are not pruned when syncing with several shards')
+        prune_assets = False
+    assets_page_title = shared_assets.page_title(repo_name)
+
+    expected_titles = {repo_name, assets_page_title}
+    for file_name in doc_files:
+        folder = file_name
+        while folder:
+            expected_titles.add(f'{repo_name}/{folder}'.replace(os.sep, '/'))
+            folder, _ = os.path.split(folder)
+
+    success = True
+    for target in get_sync_targets():
+        wiki_client = _create_wiki_client()
+        root_page_id = _get_root_page_id(wiki_client, target)
+        if not root_page_id:
+            success = False
+            continue
+
+        pages = page_index.list_descendant_pages(
+            wiki_client, root_page_id, with_body=prune_assets
+        )
+        orphaned_pages = [
+            page
+            for title, page in pages.items()
+            if title.startswith(f'{repo_name}/') and title not in expected_titles
+        ]
+        # Children first, so pages aren't moved around when their parent goes away
+        orphaned_pages.sort(key=lambda page: (-page.title.count('/'), page.title))
+
+        logging.info(
+            '%s orphaned pages out of %s in space %s: %s',
+            len(orphaned_pages),
+            len(pages),
+            target.space_name,
+            [page.title for page in orphaned_pages],
+        )
+        if mode == 'dry-run':
+            if prune_assets and assets_page_title in pages:
+                _prune_shared_assets(
+                    wiki_client, pages, orphaned_pages, assets_page_title, mode
+                )
+            continue
+
+        repo_page_count = sum(1 for title in pages if title.startswith(f'{repo_name}/'))
+        if (
+            not force
+            and len(orphaned_pages) > repo_page_count * RECONCILE_MAX_REMOVED_FRACTION
+        ):
+            logging.error(
+                'Refusing to remove %s of the %s pages of %s in space %s. Check that'
+                ' the checkout includes the whole repository, or set reconcile-force',
+                len(orphaned_pages),
+                repo_page_count,
+                repo_name,
+                target.space_name,
+            )
+            success = False
+            continue
+
+        for start in range(0, len(orphaned_pages), RECONCILE_BATCH_SIZE):
+            batch = orphaned_pages[start : start + RECONCILE_BATCH_SIZE]
+            if not _remove_pages(wiki_client, batch, mode):
+                success = False
+
+        if prune_assets and assets_page_title in pages:
+            if not _prune_shared_assets(
+                wiki_client, pages, orphaned_pages, assets_page_title, mode
+            ):
+                success = False
+
+    return success
+
+
+def _prune_shared_assets(
+    wiki_client: atlassian.Confluence,
+    pages: dict[str, page_index.IndexedPage],
+    orphaned_pages: list[page_index.IndexedPage],
+    assets_page_title: str,
+    mode: str,
+) -> bool:
+    """Removes the attachments of the shared assets page that none of the remaining
+    pages use anymore. Returns True if it worked for all"""
+    orphaned_titles = {page.title for page in orphaned_pages}
+    assets_page = shared_assets.SharedAssetsPage(
+        wiki_client, pages[assets_page_title].page_id, assets_page_title
+    )
+    assets_page.load_attachment_names()
+    return assets_page.prune(
+        [
+            page.body
+            for title, page in pages.items()
+            if title not in orphaned_titles and title != assets_page_title
+        ],
+        dry_run=mode == 'dry-run',
+    )
+
+
+def list_doc_files() -> list[str]:
+    """Lists all the files of the repository that should be synced"""
+    doc_files = []
+    for folder, subfolders, file_names in os.walk('.'):
+        if '.git' in subfolders:
+            subfolders.remove('.git')
+
+        for file_name in file_names:
+            file_path = os.path.relpath(os.path.join(folder, file_name))
+            if should_sync_file(file_path):
+                doc_files.append(file_path)
+
+    return sorted(doc_files)
+
+
+def _remove_pages(
+    wiki_client: atlassian.Confluence, pages: list[page_index.IndexedPage], mode: str
+) -> bool:
+    """Archives or deletes a batch of pages. Returns True if it worked for all"""
+    if mode == 'archive':
+        logging.info('Archiving pages %s', [page.title for page in pages])
+        try:
+            # A single request archives the whole batch
+            wiki_client.post(
+                'rest/api/content/archive',
+                data={'pages': [{'id': page.page_id} for page in pages]},
+            )
+        except Exception:
+            logging.exception('Error archiving pages:')
+            return False
+        return True
+
+    def delete_page(page: page_index.IndexedPage) -> bool:
+        logging.info('Deleting page %s', page.title)
+        try:
+            wiki_client.remove_page(page.page_id)
+        except Exception:
+            logging.exception('Error deleting page %s:', page.title)
+            return False
+        return True
+
+    # There is no bulk delete, so at least delete the batch concurrently
+    with concurrent.futures.ThreadPoolExecutor(CONCURRENT_REQUESTS) as executor:
+        return all(list(executor.map(delete_page, pages)))
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('atlassian.confluence').setLevel(logging.INFO)
     logging.getLogger('atlassian.rest_client').setLevel(logging.INFO)
     logging.getLogger('urllib3.connectionpool').setLevel(logging.INFO)
 
+    profiler = None
+    if os.environ.get('INPUT_PROFILE', 'false').lower() == 'true':
+        profiler = profiling.Profiler()
+
+    sync_success = False
     try:
-        files_to_sync = get_files_to_sync(os.environ['INPUT_MODIFIED-FILES'])
-        logging.info('Files to be synced: %s', files_to_sync)
+        with profiler or contextlib.nullcontext():
+            with profiling.stage('filtering'):
+                files_to_sync = get_files_to_sync(os.environ['INPUT_MODIFIED-FILES'])
+            logging.info('Files to be synced: %s', files_to_sync)
 
-        sync_success = sync_files(files_to_sync)
+            sync_success = sync_files(files_to_sync)
 
-        sys.exit(0 if sync_success else 1)
+            reconcile_mode = os.environ.get('INPUT_RECONCILE', '')
+            if reconcile_mode:
+                sync_success = reconcile_pages(reconcile_mode) and sync_success
     except Exception:
         logging.exception('Unhandled exception')
-        sys.exit(1)
+        sync_success = False
+
+    if profiler:
+        profiler.save(os.environ.get('INPUT_PROFILE-FOLDER') or 'wiki-sync-profile')
+
+    sys.exit(0 if sync_success else 1)